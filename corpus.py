@@ -0,0 +1,31 @@
+"""Reads strings the game translated or missed from a game log or a plain strings file.
+
+Shared by replay.py, which replays them, and rosetta.py --expand and --misses."""
+import html
+import json
+import re
+
+
+LOG_RE = re.compile(r'rosetta: (?:NOT FOUND|TRANSLATING) (.*)')
+
+def read_corpus(text):
+    """Extracts strings from a game log if it has rosetta lines, otherwise reads them one per line.
+       log.html is unescaped."""
+    strings = list(iter_log_strings(text.splitlines()))
+    if strings:
+        return strings
+    return [line.replace("\\n", "\n") for line in text.splitlines() if line]
+
+def iter_log_strings(lines, regex=LOG_RE):
+    for line in lines:
+        # Most lines aren't ours, a substring check is way faster than a regex
+        if "rosetta: " not in line or not (m := regex.search(line)):
+            continue
+        s = m.group(1)
+        if "</div>" in s:
+            s = s[:s.index("</div>")]
+        # log.html is escaped even on lines continuing a multiline string, where </div> isn't
+        s = html.unescape(s)
+        if s.startswith(('= "', '"')) and s.endswith('"'):
+            s = json.loads(s.removeprefix("= "))
+        yield s
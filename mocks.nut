@@ -15,6 +15,18 @@
     }
 }
 
+::Time <- {
+    function getExactTime() {
+        return clock()
+    }
+}
+
+::IO <- {
+    function scriptFilenameByHash(_hash) {
+        return "scripts/mock/" + _hash
+    }
+}
+
 ::Const.Strings <- {}
 ::Const.Strings.EntityName <- [
     "Некромант"
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""\
+Usage:
+    python replay.py <pair-file>... <corpus>... [options]
+
+Replays captured game strings against translation pack(s) to measure translation speed.
+Runs them through the mod under squirrel interpreter and through the Python port in runtime.py.
+
+Arguments:
+    <pair-file>     Translation file(s), i.e. rosetta_ru.nut, anything ending with .nut
+    <corpus>        A game log with rosetta NOT FOUND or TRANSLATING lines,
+                    or a plain text file with one string per line, \\n is unescaped
+
+Options:
+    -l<lang>        Language to activate, defaults to ru
+    -n<repeat>      Number of times to replay the corpus, defaults to 1
+    -r<rules>       Number of slowest rules to show, defaults to 10
+    --no-squirrel   Do not run the squirrel interpreter
+    -h, --help      Show this help
+
+Squirrel run needs squirrel on PATH and STDLIB_DIR env var or in .env, same as make test.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from corpus import read_corpus
+from runtime import Rosetta
+
+
+ROOT = Path(__file__).resolve().parent
+OPTS = {"lang": "ru", "repeat": 1, "rules": 10, "squirrel": True}
+
+
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv:
+        print(__doc__)
+        return
+
+    packs, corpora = [], []
+    for arg in sys.argv[1:]:
+        if arg == "--no-squirrel":
+            OPTS["squirrel"] = False
+        elif arg.startswith("-l"):
+            OPTS["lang"] = arg[2:]
+        elif arg.startswith("-n"):
+            OPTS["repeat"] = int(arg[2:])
+        elif arg.startswith("-r"):
+            OPTS["rules"] = int(arg[2:])
+        elif arg.startswith("-"):
+            exit(f"Unknown option {arg}")
+        elif arg.endswith(".nut"):
+            packs.append(arg)
+        else:
+            corpora.append(arg)
+    if not packs or not corpora:
+        exit("Please specify pair file(s) and corpus")
+
+    strings = []
+    for corpus in corpora:
+        strings.extend(read_corpus(Path(corpus).read_text(encoding="utf-8", errors="replace")))
+    print(f"Corpus: {len(strings)} strings, {len(set(strings))} unique")
+
+    result = replay_python(packs, strings, repeat=OPTS["repeat"])
+    report("Python", result, len(strings) * OPTS["repeat"])
+
+    if OPTS["squirrel"]:
+        if not shutil.which("squirrel"):
+            print("Squirrel: not found on PATH, skipping", file=sys.stderr)
+        else:
+            result = replay_squirrel(packs, strings, repeat=OPTS["repeat"])
+            report("Squirrel", result, len(strings) * OPTS["repeat"])
+
+def exit(message):
+    print(message, file=sys.stderr)
+    sys.exit(1)
+
+def report(name, result, total):
+    stats, elapsed = result["stats"], result["time"]
+    rate = total / elapsed if elapsed else float("inf")
+    print(f"{name}: {total} strings in {elapsed:.3f}s, {rate:.0f} strings/s")
+    num = sum(stats.values()) or 1
+    print("    " + ", ".join(f"{key} {stats[key] / num:.1%}"
+                             for key in ("hits", "rule_hits", "misses")))
+    rules = sorted(result["rules"].items(), key=lambda item: -item[1][0])
+    if rules:
+        print("    slowest rules:")
+    for en, (spent, calls) in rules[:OPTS["rules"]]:
+        en = en.replace("\n", "\\n")
+        print(f"    {spent * 1000:9.2f}ms {calls:7} calls  {en}")
+
+
+# Python
+
+class ProfiledRosetta(Rosetta):
+    def __init__(self):
+        super().__init__()
+        self.rule_times = defaultdict(lambda: [0.0, 0])
+
+    def try_rule(self, rule, s):
+        start = time.perf_counter()
+        try:
+            return super().try_rule(rule, s)
+        finally:
+            stat = self.rule_times[rule["en"]]
+            stat[0] += time.perf_counter() - start
+            stat[1] += 1
+
+def replay_python(packs, strings, repeat=1):
+    rosetta = Rosetta()
+    rosetta.activate(OPTS["lang"])
+    for pack in packs:
+        rosetta.load(pack, lang=OPTS["lang"])
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for s in strings:
+            rosetta.translate(s)
+    elapsed = time.perf_counter() - start
+
+    # A separate pass not to mess up the timing
+    profiled = ProfiledRosetta()
+    profiled.langs, profiled.maps, profiled.active = rosetta.langs, rosetta.maps, rosetta.active
+    for s in strings:
+        profiled.translate(s)
+
+    stats = {key: val // repeat for key, val in rosetta.stats.items() if key != "rule_uses"}
+    return {"time": elapsed, "stats": stats, "rules": dict(profiled.rule_times)}
+
+
+# Squirrel
+
+DRIVER = '''\
+dofile(getenv("STDLIB_DIR") + "load.nut", true);
+dofile("load.nut", true);
+::Rosetta.activate(%(lang)s);
+%(packs)s
+local def = ::Rosetta, amap = def.maps[def.active];
+local strings = [
+%(strings)s
+];
+
+local stats = {hits = 0, rule_hits = 0, misses = 0};
+foreach (s in strings) {
+    if (def.translate(s) == s) stats.misses++;
+    else if (s in amap.strs) stats.hits++;
+    else stats.rule_hits++;
+}
+print(format("stats %%d %%d %%d\\n", stats.hits, stats.rule_hits, stats.misses));
+
+// Memo and missed caches would make repeats cache hits, the Python port has none of them
+local elapsed = 0.0;
+for (local i = 0; i < %(repeat)d; i++) {
+    def.clearMemo();
+    local start = clock();
+    foreach (s in strings) def.translate(s);
+    elapsed += clock() - start;
+}
+print(format("time %%f\\n", elapsed));
+
+// Only time matching here, translate() has no hooks to do that
+local times = {}, calls = {};
+foreach (s in strings) {
+    foreach (key in def._iterKeys(s)) {
+        if (!(key in amap.rules)) continue;
+        foreach (rule in amap.rules[key]) {
+            local t = clock();
+            def.matchParts(s, rule.parts);
+            t = clock() - t;
+            if (rule.en in times) {times[rule.en] += t; calls[rule.en]++}
+            else {times[rule.en] <- t; calls[rule.en] <- 1}
+        }
+    }
+}
+foreach (en, t in times) {
+    print(format("rule %%f %%d ", t, calls[en]) + ::std.Re.replace(en, @"\\n", @"\\n") + "\\n");
+}
+'''
+
+def replay_squirrel(packs, strings, repeat=1):
+    from rosetta import nutstr
+
+    driver = DRIVER % {
+        "lang": nutstr(OPTS["lang"]),
+        "packs": "\n".join(f"dofile({nutstr(str(Path(p).resolve()))}, true);" for p in packs),
+        "strings": "\n".join(f"    {nutstr(s)}" for s in strings),
+        "repeat": repeat,
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".nut", encoding="utf-8", delete=False) as fd:
+        fd.write(driver)
+    try:
+        env = {**_dotenv(), **os.environ}
+        proc = subprocess.run(["squirrel", fd.name], cwd=ROOT, env=env,
+                              capture_output=True, text=True)
+    finally:
+        os.unlink(fd.name)
+    if proc.returncode:
+        exit(f"Squirrel failed:\n{proc.stderr}")
+
+    result = {"time": 0.0, "stats": {}, "rules": {}}
+    for line in proc.stdout.splitlines():
+        if line.startswith("stats "):
+            result["stats"] = dict(zip(("hits", "rule_hits", "misses"), map(int, line.split()[1:])))
+        elif line.startswith("time "):
+            result["time"] = float(line.split()[1])
+        elif line.startswith("rule "):
+            _, spent, calls, en = line.split(" ", 3)
+            result["rules"][en.replace("\\n", "\n")] = (float(spent), int(calls))
+    return result
+
+def _dotenv():
+    env_file = ROOT / ".env"
+    if not env_file.exists():
+        return {}
+    lines = env_file.read_text().splitlines()
+    return dict(line.split("=", 1) for line in lines if "=" in line and not line.startswith("#"))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,11 @@
 Usage:
     python rosetta.py <mod-file> > <to-file> [options]
     python rosetta.py <mod-dir> > <to-file> [options]
+    python rosetta.py -o<old-mod> <mod-dir> > <to-file> [options]
+    python rosetta.py --expand <mod-file> <corpus-or-range> > <to-file> [options]
+    python rosetta.py --misses <log-file>... > <to-file> [options]
+    python rosetta.py --merge <pair-file>... > <to-file> [options]
+    python rosetta.py --serve [<socket>] [options]
 
 Extracts strings and prepares a rosetta style translation file.
 
@@ -14,13 +19,32 @@ Arguments:
 Options:
     -l<lang>      Target language to translate to, defaults to ru
     -t<engine>    Use automatic translation. Available options are:
-                      yt (Yandex Translate), claude35 (Anthropic Claude-3.5-sonnet)
+                      yt (Yandex Translate), claude35 (Anthropic Claude-3.5-sonnet),
+                      mock (offline, for testing)
     -r<file>      Use this as reference translation
     -c<file>      Check mode: report new, unmatched and partial entries, exit 1 if any
+    -o<old-mod>   Bootstrap from an old translated copy of the mod, a dir or a zip, takes
+                  translations from strings in the same file and context
     -f            Overwrite existing files
     -q            Less output
     -x            Stop on error
     --context     Include context comments into generated code
+    --resume      Continue the last unfinished -t run over the same path, retry failed texts
+    --compile     Precompile <mod-file>, a translation file, for faster loading in game
+    --expand      Write literal pairs for frequent instantiations of patterns in <mod-file>,
+                  a translation file, strings are taken from a corpus, i.e. a game log,
+                  or made by putting a range of ints, i.e. 0..100, into :int captures
+    -n<num>       Number of the most frequent corpus strings to expand, defaults to 1000
+    --misses      Make pairs for strings in game logs the runtime didn't find, skipping ones
+                  in reference, numbers are turned into patterns
+    --merge       Merge translation files into one pack, dropping duplicates and reporting
+                  conflicts
+    --strip       Strip comments when merging
+    --format <f>  Output format: nut, the default, or jsonl, an object per string, written as
+                  soon as found, with file, line, en, mode, <lang>, code, context and ref
+    --serve       Answer JSON-RPC requests over stdin/stdout or a unix socket, keeping refs
+                  loaded and extracted files cached. Methods: extract_file(path),
+                  check_file(path), lookup_en(en), reload_reference(ref=None)
     -h, --help    Show this help
 """
 # TODO: autopattern for
@@ -31,16 +55,22 @@ Options:
 # TODO: autodetect integer when - * / ops are used:
 #       "And <inv.len()><-><::Const.World.Common.WorldEconomy.Trade.AmountOfLeakedCaravanInventoryInfo> more item(s)"
 # TODO: translate to other languages (xt)
-# TODO: do not translate <tags> (xt)
 # TODO: mod/file specific includes, i.e.:
 #       - legends/**/trait_defs.nut Const = ....
-from collections import defaultdict, namedtuple
+from collections import Counter, defaultdict, namedtuple
+from difflib import SequenceMatcher
 from itertools import count, groupby
 from pathlib import Path
+from hashlib import blake2b
 import ast
+import inspect
+import json
 import os
 import sys
+import time
+import zipfile
 import re
+import struct
 from pprint import pprint, pformat
 
 
@@ -59,7 +89,10 @@ NUT_FOOTER = """
 ::Rosetta.add(rosetta, pairs);""".lstrip()
 
 OPTS = {"lang": "ru", "engine": None, "ref": None, "check": None,
-        "debug": False, "failfast": False, "context": False, "quiet": False}
+        "debug": False, "failfast": False, "context": False, "quiet": False, "resume": False,
+        "compile": False, "expand": False, "top": None, "misses": False,
+        "merge": False, "strip": False, "old": None, "serve": False,
+        "format": "nut"}
 
 def main():
     if "-h" in sys.argv or "--help" in sys.argv:
@@ -67,18 +100,25 @@ def main():
         return
 
     bool_opts = {"f": "force", "t": "tabs", "d": "debug", "x": "failfast", "q": "quiet"}
-    long_opts = {"context": "context"}
-    arg_opts = {"l": "lang", "t": "engine", "r": "ref", "c": "check"}
+    long_opts = {"context": "context", "resume": "resume", "compile": "compile",
+                 "expand": "expand", "misses": "misses", "merge": "merge", "strip": "strip",
+                 "serve": "serve"}
+    arg_opts = {"l": "lang", "t": "engine", "r": "ref", "c": "check", "n": "top",
+                "o": "old"}
+    long_arg_opts = {"format": "format"}
 
     # Parse options
     args = []
     arg_it = iter(sys.argv[1:])
     for x in arg_it:
         if x.startswith("--"):
-            name = x[2:]
-            if name not in long_opts:
+            name, eq, val = x[2:].partition("=")
+            if name in long_arg_opts:
+                OPTS[long_arg_opts[name]] = val if eq else next(arg_it)
+            elif name in long_opts and not eq:
+                OPTS[long_opts[name]] = True
+            else:
                 exit('Unknown option "%s"' % x)
-            OPTS[long_opts[name]] = True
         elif x[0] != "-" or x == "-":
             args.append(x)
         elif x[1] in arg_opts:
@@ -92,32 +132,81 @@ def main():
                     exit('Unknown option "-%s"' % o)
                 OPTS[bool_opts[o]] = True
 
+    if OPTS["serve"]:
+        if OPTS["engine"] or OPTS["check"] or len(args) > 1:
+            exit("--serve only takes an optional socket path, -l and -r")
+        serve(args[0] if args else None)
+        return
+
     # Validate args
     if len(args) < 1:
         exit("Please specify file or dir")
-    elif len(args) > 2:
+    elif len(args) > 2 and not (OPTS["misses"] or OPTS["merge"]):
         exit("Too many arguments")
 
+    if OPTS["old"] and (OPTS["ref"] or OPTS["check"]):
+        exit("-o can't be used with -r or -c")
+    if OPTS["format"] not in {"nut", "jsonl"}:
+        exit('Unknown format "%s", use nut or jsonl' % OPTS["format"])
+    if OPTS["format"] == "jsonl" and (OPTS["engine"] or OPTS["check"] or OPTS["old"]):
+        exit("--format jsonl can't be used with -t, -c or -o")
+
     path = args[0]
     outfile = args[1] if len(args) >= 2 else None
 
+    if OPTS["compile"]:
+        print(compile_file(path), end="")
+        return
+    if OPTS["expand"]:
+        if not outfile:
+            exit("Please specify a corpus or a range to expand")
+        print(expand_file(path, outfile), end="")
+        return
+    if OPTS["merge"]:
+        merge_files(args)
+        return
+
     if OPTS["engine"]:
         import xt
         xt.init()
 
-    pack = Path(__file__).resolve().parent / "rosetta" / f'pack_{OPTS["lang"]}.nut'
-    if pack.exists():
-        load_ref(str(pack), silent=True)
+    load_pack()
 
     if OPTS["check"]:
         load_ref(OPTS["check"])
         run_check(path)
         return
 
+    if OPTS["old"]:
+        extract_old(path, OPTS["old"])
+        return
+
     if OPTS["ref"]:
         load_ref(OPTS["ref"])
 
-    extract_path(path)
+    if OPTS["misses"]:
+        extract_misses(args)
+        return
+
+    if OPTS["format"] == "jsonl":
+        extract_path(path, out=lambda line: print(line, flush=True))
+        return
+
+    if not OPTS["engine"]:
+        extract_path(path)
+        return
+
+    run_params = [str(Path(path).resolve()), OPTS["lang"], OPTS["engine"], OPTS["ref"],
+                  OPTS["context"]]
+    DONE_FILES.update(xt.start_run(run_params, resume=OPTS["resume"]))
+    xt.retry_pending(OPTS["engine"])
+    try:
+        extract_path(path)
+    except KeyboardInterrupt:
+        exit("Interrupted, use --resume to continue")
+    xt.report()
+    if failed := xt.finish_run():
+        warn(f"Failed to translate {failed} texts, use --resume to retry them")
 
 
 def exit(message):
@@ -176,11 +265,13 @@ def run_check(path):
 
 
 def check(path):
-    lang = OPTS["lang"]
     collected = []
     extract_path(path, out=collected.append)
+    return check_blocks(collected)
 
-    new_blocks = [b for b in collected if f'{lang} = ""' in b]
+def check_blocks(collected):
+    lang = OPTS["lang"]
+    new_blocks = [b for b in collected if f'{lang} = ""' in b or b.lstrip().startswith('// FUZZY')]
 
     used_ens = {ast.literal_eval(f'"{m.group(1)}"') for b in collected if f'{lang} = ""' not in b
                 for m in re.finditer(r'\ben\s*=\s*"([^"]+)"', b, re.MULTILINE)}
@@ -214,25 +305,596 @@ def _leaked_literals(block, seen):
     return leaked
 
 
+# Server
+
+SERVE_FILES = {}  # filename -> (mtime, size, candidates)
+SERVE_CODE_RULES = {}  # CODE_RULES as loaded, ref_code() empties them on use
+
+def serve(address=None):
+    """Answers JSON-RPC requests, one per line, over stdin/stdout or a unix socket"""
+    reload_reference()
+    if address is None:
+        for line in sys.stdin:
+            if (response := serve_line(line)) is not None:
+                print(response, flush=True)
+        return
+
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if (response := serve_line(line.decode('utf8'))) is not None:
+                    self.wfile.write(response.encode('utf8') + b'\n')
+
+    if os.path.exists(address):
+        os.unlink(address)
+    with socketserver.UnixStreamServer(address, Handler) as server:
+        if not OPTS["quiet"]:
+            print(green(f"Serving on {address}"), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(address)
+
+def serve_line(line):
+    if not line.strip():
+        return None
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return _rpc_error(None, -32700, f"Parse error: {e}")
+    req_id = request.get("id") if isinstance(request, dict) else None
+    if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+        return _rpc_error(req_id, -32600, "Invalid request")
+    if (method := SERVE_METHODS.get(request["method"])) is None:
+        return _rpc_error(req_id, -32601, f'Method not found: {request["method"]}')
+
+    params = request.get("params", {})
+    if not isinstance(params, (list, dict)):
+        return _rpc_error(req_id, -32602, "Invalid params: should be an array or an object")
+    args = params if isinstance(params, list) else []
+    kwargs = params if isinstance(params, dict) else {}
+    try:
+        inspect.signature(method).bind(*args, **kwargs)
+    except TypeError as e:
+        return _rpc_error(req_id, -32602, f"Invalid params: {e}")
+    try:
+        result = method(*args, **kwargs)
+    except (Exception, SystemExit) as e:
+        # exit() has already written the message to stderr
+        import traceback
+        message = traceback.format_exc() if isinstance(e, Exception) else "Failed, see stderr"
+        if isinstance(e, Exception):
+            warn(message)
+        return _rpc_error(req_id, -32000, message)
+    if "id" in request:
+        return json.dumps({"jsonrpc": "2.0", "id": req_id, "result": result}, ensure_ascii=False)
+
+def _rpc_error(req_id, code, message):
+    return json.dumps({"jsonrpc": "2.0", "id": req_id, "error": {"code": code, "message": message}},
+                      ensure_ascii=False)
+
+def serve_extract_file(path):
+    return {"blocks": _serve_blocks(path)}
+
+def serve_check_file(path):
+    new_blocks, unmatched_blocks, partial_blocks = check_blocks(_serve_blocks(path))
+    result = {"new": new_blocks, "partial": [{"block": _format(b), "untranslated": leaked}
+                                             for b, leaked in partial_blocks]}
+    # Only a whole mod may tell which reference entries are not used anymore
+    if Path(path).is_dir():
+        result["unmatched"] = [_format(b) for b in unmatched_blocks]
+    return result
+
+def serve_lookup_en(en):
+    """Returns a reference block for en, "" if it's covered by a language pack, None if none"""
+    pair = ref_en(en)
+    return _format(pair) if pair else pair
+
+def reload_reference(ref=None):
+    prev_ref = OPTS["ref"]
+    if ref is not None:
+        OPTS["ref"] = ref
+    try:
+        _load_reference()
+    except (Exception, SystemExit):
+        # Keep serving the previous reference rather than an empty or a half loaded one
+        OPTS["ref"] = prev_ref
+        _load_reference()
+        raise
+    SERVE_CODE_RULES.clear()
+    SERVE_CODE_RULES.update(CODE_RULES)
+    return {"pairs": len(REF_PAIRS), "rules": len(REF_RULE_LIST)}
+
+def _load_reference():
+    reset_ref()
+    load_pack()
+    if OPTS["ref"]:
+        load_ref(OPTS["ref"])
+
+SERVE_METHODS = {"extract_file": serve_extract_file, "check_file": serve_check_file,
+                 "lookup_en": serve_lookup_en, "reload_reference": reload_reference}
+
+def _serve_blocks(path):
+    """Same blocks as extract_path() would output, extracting only changed files"""
+    path = Path(path)
+    if path.is_dir():
+        files = list(iter_mod_files(path))
+    elif path.is_file():
+        files = [path]
+    else:
+        exit("File not found: " + str(path))
+
+    SEEN.clear()
+    CODE_RULES.clear()
+    CODE_RULES.update(SERVE_CODE_RULES)
+    blocks = []
+    for filename in files:
+        pairs = filter(None, (extract_pair(cand) for cand in _serve_candidates(filename)))
+        blocks.extend(_format(pair) for pair in pairs)
+    return blocks
+
+def _serve_candidates(filename):
+    stat = filename.stat()
+    key = str(filename.resolve())
+    cached = SERVE_FILES.get(key)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    candidates = list(iter_candidates(filename.read_text(encoding='utf8')))
+    SERVE_FILES[key] = (stat.st_mtime_ns, stat.st_size, candidates)
+    return candidates
+
+
+# Compile
+
+def compile_file(filename):
+    """Rewrites pairs passed to ::Rosetta.add() into structures the runtime builds from them,
+       i.e. parsed patterns, replacements and rule key words, to be loaded by
+       ::Rosetta.addCompiled()"""
+    import runtime
+
+    with open(filename, encoding='utf-8') as fd:
+        text = fd.read()
+    nut = runtime.parse_nut(text)
+    edits = {}
+    for call in nut.calls:
+        if call.name != 'add' or len(call.args) != 2:
+            continue
+        desc, pairs = map(nut.resolve, call.args)
+        if not isinstance(pairs, list):
+            warn(f"{filename}: can't compile pairs {call.args[1].source}, not a literal")
+            continue
+        lang = desc.get('lang') if isinstance(desc, dict) else None
+        lang = lang if isinstance(lang, str) else OPTS['lang']
+
+        compiler = runtime.Rosetta()
+        try:
+            compiler.add({'lang': lang}, pairs)
+        except runtime.RosettaError as e:
+            exit(f"{filename}: {e}")
+        amap = compiler.maps.get(lang) or compiler._new_map()
+
+        arg = call.args[1]
+        span = nut.spans[arg.source] if isinstance(arg, runtime.NutExpr) else call.spans[1]
+        edits[span] = _compiled_nut(amap)
+        edits[(call.pos, call.pos + len(call.name))] = 'addCompiled'
+
+    if not edits:
+        exit(f"{filename}: no ::Rosetta.add() calls found")
+    for start, end in sorted(edits, reverse=True):
+        text = text[:start] + edits[start, end] + text[end:]
+    return text
+
+def _compiled_nut(amap):
+    lines = ['{']
+    for name in ('strs', 'ids'):
+        if not amap[name]:
+            lines.append(f'    {name} = {{}}')
+            continue
+        lines.append(f'    {name} = {{')
+        lines.extend(f'        [{nutstr(k)}] = {nutstr(v)}' for k, v in amap[name].items())
+        lines.append('    }')
+    # Added order, keys to put them by are chosen at runtime, see _buildRules() there
+    lines.append('    rules = [')
+    for rule in amap['ruleList']:
+        lines.append('        {')
+        lines.extend(f'            {_nutkey(k)} = {_nutval(v)}' for k, v in rule.items())
+        lines.append('        }')
+    lines.append('    ]')
+    lines.append('}')
+    return '\n'.join(lines)
+
+NUT_KEYWORDS = set("""
+    base break case catch class clone continue const constructor default delete else enum
+    extends false for foreach function if in instanceof local null resume return static switch
+    this throw true try typeof while yield
+""".split())
+
+def _nutkey(key):
+    if re.fullmatch(r'[a-zA-Z_]\w*', key) and key not in NUT_KEYWORDS:
+        return key
+    return f'[{nutstr(key)}]'
+
+def _nutval(val):
+    import runtime
+
+    if isinstance(val, str):
+        return nutstr(val)
+    elif val is None:
+        return 'null'
+    elif isinstance(val, bool):
+        return 'true' if val else 'false'
+    elif isinstance(val, (int, float)):
+        return repr(val)
+    elif isinstance(val, runtime.Capture):
+        return f'{{name = {nutstr(val.name)}, sub = {nutstr(val.sub)}}}'
+    elif isinstance(val, runtime.Sub):
+        return f'{{name = {nutstr(val.name)}, flags = {_nutval(val.flags or None)}}}'
+    elif isinstance(val, (runtime.NutFunction, runtime.NutExpr)):
+        return val.source
+    elif isinstance(val, list):
+        return '[' + ', '.join(map(_nutval, val)) + ']'
+    elif isinstance(val, dict):
+        return '{' + ', '.join(f'{_nutkey(k)} = {_nutval(v)}' for k, v in val.items()) + '}'
+    raise TypeError(f"Can't convert {val!r} to squirrel")
+
+
+# Expand
+
+EXPAND_HEADER = """
+// Generated by rosetta.py --expand {source} {spec}
+// Literal pairs for frequent pattern and plural instantiations, load after the source file
+if (!("Rosetta" in getroottable())) return;
+
+local rosetta = {{
+    mod = {{id = {id}, version = {version}}}
+    lang = "{lang}"
+}}
+local pairs = [""".lstrip()
+
+RANGE_RE = re.compile(r'(-?\d+)\.\.(-?\d+)')
+
+def expand_file(filename, spec):
+    """Materializes instantiations of pattern and plural rules in a translation file as literal
+       pairs, so that the runtime finds them in strs without matching. spec is either a corpus,
+       strings are taken the most frequent first, or a range of ints, i.e. 0..100, to put into
+       rules with a single :int capture."""
+    import runtime
+
+    class ExpandRosetta(runtime.Rosetta):
+        last_rule = None  # The rule the last string was translated with
+
+        def try_rule(self, rule, s):
+            ret = super().try_rule(rule, s)
+            if ret is not None:
+                self.last_rule = rule
+            return ret
+
+    lang = OPTS["lang"]
+    rosetta = ExpandRosetta()
+    rosetta.activate(lang)
+    rosetta.load(filename, lang=lang)
+    amap = rosetta.maps.get(lang) or rosetta._new_map()
+
+    if m := RANGE_RE.fullmatch(spec):
+        start, end = int(m[1]), int(m[2])
+        strings = []
+        for rule in amap["ruleList"]:
+            captures = [p for p in rule["parts"] if isinstance(p, runtime.Capture)]
+            if len(captures) == 1 and captures[0].sub == "int":
+                strings.extend(''.join(p if isinstance(p, str) else str(n) for p in rule["parts"])
+                               for n in range(start, end + 1))
+        top = None
+    else:
+        from corpus import read_corpus
+        corpus = read_corpus(Path(spec).read_text(encoding="utf-8", errors="replace"))
+        strings = [s for s, _ in Counter(corpus).most_common()]
+        top = int(OPTS["top"] or 1000)
+
+    pairs = {}
+    for s in strings:
+        if s in pairs or s in amap["strs"]:
+            continue
+        rosetta.last_rule = None
+        ret = rosetta.translate(s)
+        if ret != s and rosetta.last_rule and _expandable(rosetta.last_rule, lang):
+            pairs[s] = ret
+            if len(pairs) == top:
+                break
+
+    # The literals should change nothing but the speed, including strings not expanded,
+    # i.e. captures translated with :t
+    expanded = runtime.Rosetta()
+    expanded.activate(lang)
+    expanded.load(filename, lang=lang)
+    expanded.add({"lang": lang}, [{"en": en, lang: tr} for en, tr in pairs.items()])
+    for s in dict.fromkeys(strings):
+        if (got := expanded.translate(s)) != (want := rosetta.translate(s)):
+            exit(f"Expanded {s!r} translates to {got!r} instead of {want!r}")
+
+    desc = _first_desc(filename)
+    mod = desc.get("mod") if isinstance(desc.get("mod"), dict) else {}
+    lines = [EXPAND_HEADER.format(
+        source=Path(filename).name, spec=spec, lang=lang,
+        id=_nutval(mod["id"]) if isinstance(mod.get("id"), str) else '"mod_"',
+        version=_nutval(mod["version"]) if isinstance(mod.get("version"), str) else '"..."',
+    )]
+    for en, tr in pairs.items():
+        lines.append(f"    {{\n        en = {nutstr(en)}\n        {lang} = {nutstr(tr)}\n    }}")
+    lines.append(NUT_FOOTER)
+    debug(f"Expanded {len(pairs)} strings")
+    return '\n'.join(lines) + '\n'
+
+def _expandable(rule, lang):
+    """Whether rule output depends only on a string, not on other rules and pairs"""
+    import runtime
+
+    if "split" in rule or "use" in rule:
+        return False
+    outs = [val for key, val in rule.items() if key == lang or len(key) == 2 and key[0] == 'n']
+    return not any(isinstance(p, runtime.Sub) and p.flags == "t" for out in outs for p in out)
+
+def _first_desc(filename):
+    import runtime
+
+    nut = runtime.parse_nut(Path(filename).read_text(encoding="utf-8"))
+    for call in nut.calls:
+        if call.args and isinstance(desc := nut.resolve(call.args[0]), dict):
+            return desc
+    return {}
+
+
+# Misses
+
+MISS_RE = re.compile(r'rosetta: NOT FOUND (.*)')
+# A number colored or not, other tags are kept as is
+MISS_NUM_RE = re.compile(
+    r'(\[color=[^\]]+\])([+\-]?\d+(?:\.\d+)?%?)(\[/color\])|(\[[^\]]*\])'
+    r'|(?<![\w#.])([+\-]?\d+(?:\.\d+)?%?)(?![\w.]\w)')
+
+def extract_misses(paths, out=print):
+    """Reads NOT FOUND strings from game logs, the runtime writes them with logging on,
+       and emits pairs for the ones the reference doesn't cover. Strings different only by numbers
+       are grouped into patterns, the most frequent first."""
+    from corpus import iter_log_strings
+
+    misses = Counter()
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as fd:
+            misses.update(iter_log_strings(fd, MISS_RE))
+
+    # Reference rules match <...> in place of captures, so patterns are checked against them too,
+    # while concrete strings are translated same as the game does
+    covers = _ref_runtime_covers()
+    groups = defaultdict(Counter)
+    for s, n in misses.items():
+        if is_interesting(s) and ref_en(s) is None and not covers(s):
+            groups[_miss_pattern(s)][s] += n
+    groups = {en: strs for en, strs in groups.items() if en in strs or ref_en(en) is None}
+
+    out(NUT_HEADER.format(**OPTS))
+    for en, strs in sorted(groups.items(), key=lambda item: -item[1].total()):
+        if en not in strs:
+            example = strs.most_common(1)[0][0]
+            out(f"    // NOT FOUND {strs.total()} times, i.e. {nutstr(example)}")
+            out(_format({"mode": "pattern", "en": en, OPTS["lang"]: ""}))
+        else:
+            out(_format({"en": en, OPTS["lang"]: ""}))
+    out(NUT_FOOTER)
+    if not OPTS["quiet"]:
+        print(green(f"Found {len(misses)} missed strings, {len(groups)} pairs"), file=sys.stderr)
+
+def _ref_runtime_covers():
+    """Returns a function telling if the runtime with the pack and the reference loaded
+       translates a string"""
+    import runtime
+
+    class CoverRosetta(runtime.Rosetta):
+        def use_rule(self, rule, s, matches):
+            # A use function is squirrel code, can't run it, but the rule still covers the string
+            return s if "use" in rule else super().use_rule(rule, s, matches)
+
+    lang = OPTS["lang"]
+    rosetta = CoverRosetta()
+    if lang not in rosetta.langs:
+        return lambda s: False
+    rosetta.activate(lang)
+    for ref in [pack_file(), OPTS["ref"]]:
+        if ref and Path(ref).exists():
+            rosetta.load(ref, lang=lang)
+
+    def covers(s):
+        misses = rosetta.stats["misses"]
+        rosetta.translate(s)
+        return rosetta.stats["misses"] == misses
+    return covers
+
+def _miss_pattern(s):
+    names = count(1)
+
+    def repl(m):
+        if m[4]:
+            return m[4]
+        val = m[2] or m[5]
+        n = next(names)
+        name = "n" if n == 1 else f"n{n}"
+        sub = "int" if re.fullmatch(r'[+\-]?\d+', val) else "val"
+        return f"<{name}:{sub}_tag>" if m[2] else f"<{name}:{sub}>"
+
+    return MISS_NUM_RE.sub(repl, s)
+
+
+# Merge
+
+def merge_files(filenames, out=print):
+    """Merges translation files into a single pack. Exact duplicates are dropped, conflicting
+       ones are reported. Same as when loading the files one by one in the runtime, the last
+       literal or id pair wins, while for rules the first one does. Rules keep their order,
+       as the runtime tries the ones that might match the same string in it."""
+    import runtime
+
+    texts = [Path(filename).read_text(encoding='utf-8') for filename in filenames]
+    pairs, skips, dups, conflicts = {}, {}, 0, 0
+    for filename, text in zip(filenames, texts):
+        for kind, key, block in iter_ref_blocks(text):
+            if OPTS["strip"] and kind != 'no_en':
+                block = strip_comments(block)
+            block = '    ' + block.strip()
+            if kind == 'no_en':
+                skips.setdefault(key, block)
+                continue
+            key = kind, key
+            if key not in pairs:
+                pairs[key] = block
+            elif _block_meat(pairs[key]) == _block_meat(block):
+                dups += 1
+            else:
+                keep = "first" if kind == 'rule' else "last"
+                warn(f"CONFLICT in {filename}, keeping the {keep} one:")
+                warn(pairs[key])
+                warn(block)
+                if keep == "last":
+                    pairs[key] = block
+                conflicts += 1
+
+    # Not sorting rules by their runtime keys here: those depend on word frequencies across
+    # all the packs loaded in game, not only the merged ones
+    blocks = [block for key, block in pairs.items() if key[0] != 'rule']
+    blocks.extend(block for key, block in pairs.items() if key[0] == 'rule')
+    blocks.extend(skips.values())
+    output = '\n'.join([NUT_HEADER.format(**OPTS), *blocks, NUT_FOOTER])
+    out(output)
+
+    def load_time(texts):
+        start = time.perf_counter()
+        for text in texts:
+            runtime.Rosetta().load_text(text, lang=OPTS["lang"])
+        return time.perf_counter() - start
+
+    before, after = load_time(texts), load_time([output])
+    print(green(f"Merged {len(filenames)} files into {len(pairs)} pairs, dropped {dups} duplicates"
+                + (f", {conflicts} conflicts" if conflicts else "")
+                + f". Load time {before * 1000:.1f}ms -> {after * 1000:.1f}ms"), file=sys.stderr)
+
+def iter_ref_blocks(text):
+    """Yields (kind, key, text) for pair blocks and // en = "..." skips of a translation file.
+       kind is one of str, id, rule or no_en, key is (en, id) for pairs, as a pair with en
+       may also have id, and en for skips. Other blocks, like translation description,
+       are skipped."""
+    level, block, en, top = 0, '', None, ''
+    for m, tok, val in iter_ref_tokens(text):
+        if level > 0:
+            block += m
+        if tok == 'open':
+            if level == 0:
+                block, en, top = m, None, ''
+            level += 1
+        elif tok == 'close':
+            level -= 1
+            if level == 0:
+                id_m = re.search(r'(?<!\S)id\s*=\s*(' + _STR + ')', top)
+                id = id_m and parse_nutstr(id_m[1])
+                if en:
+                    yield ('rule' if '<' in en else 'str'), (en, id), block
+                elif id:
+                    yield 'id', (None, id), block
+        elif tok == 'en' and level == 1:
+            en = parse_nutstr(val)
+        elif tok == 'other' and level == 1:
+            top += m
+        elif tok == 'no_en' and level == 0:
+            yield 'no_en', parse_nutstr(val), m
+
+def strip_comments(block):
+    return ''.join(m for m, tok, _ in iter_ref_tokens(block) if tok not in ('code', 'no_en'))
+
+def _block_meat(block):
+    return ' '.join(strip_comments(block).split())
+
+
 # Reference
 
-_REF_TOKEN_RE = re.compile(r'\s*(?:'
-    r'//\s*en\s*=\s*(?P<no_en>"(?:[^"\\]|\\.)+").*'
-    r'|(?P<code>//[^\n]*)'
-    r'|(?P<open>\{)'
-    r'|(?P<close>\},?)'
-    r'|en\s*=\s*(?P<en>"(?:[^"\\]|\\.)+"),?'
-    # Strings, chars and comments are matched whole, so that braces inside them are not
-    # mistaken for block delimiters. NOTE: verbatim @"" strings are not handled.
-    r"""|(?P<other>(?:"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|(?s:/\*.*?\*/)|[^\s{}"'])+)"""
-r')')
+# A hand-rolled scanner for translation files. Yields (text, kind, value) tokens, where kind is:
+#   no_en - commented out pair en, i.e. // en = "...", value is its string literal
+#   code  - a // comment
+#   open, close - block delimiters
+#   en    - en = "..." with a non-empty string literal as value
+#   other - anything else up to a whitespace, strings, chars and /* */ comments are taken whole,
+#           so that braces inside them are not mistaken for block delimiters
+# Text includes preceding whitespace, so that concatenated texts reproduce the source.
+# Every step is either a plain index lookup or an anchored regex without nested repetition,
+# so this is linear and doesn't backtrack on long strings or unbalanced quotes.
+
+_SPACE_RE = re.compile(r'\s*')
+_STR = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_VERBATIM = r'@"[^"]*(?:""[^"]*)*"'
+_NO_EN_RE = re.compile(r'//\s*en\s*=\s*("(?!")[^"\\\n]*(?:\\.[^"\\\n]*)*")[^\n]*')
+_EN_RE = re.compile(fr'en\s*=\s*((?!"")(?!@"")(?:{_STR}|{_VERBATIM})),?')
+_STR_RE = re.compile(_STR)
+_VERBATIM_RE = re.compile(_VERBATIM)
+_CHAR_RE = re.compile(r"'[^'\\]*(?:\\.[^'\\]*)*'")
+_PLAIN_RE = re.compile(r'[^\s{}"\'/@]+')
 
 def iter_ref_tokens(text):
-    for m in _REF_TOKEN_RE.finditer(text):
-        yield m.group(0), m.lastgroup, m.group(m.lastgroup)
+    pos, n = 0, len(text)
+    while True:
+        start, begin = pos, _SPACE_RE.match(text, pos).end()
+        if begin >= n:
+            return
+        c = text[begin]
+        if c == '/' and text.startswith('//', begin):
+            if m := _NO_EN_RE.match(text, begin):
+                pos, kind, val = m.end(), 'no_en', m.group(1)
+            else:
+                pos = text.find('\n', begin)
+                pos, kind = n if pos == -1 else pos, 'code'
+        elif c == '{':
+            pos, kind = begin + 1, 'open'
+        elif c == '}':
+            pos, kind = begin + (2 if text.startswith(',', begin + 1) else 1), 'close'
+        elif c == 'e' and (m := _EN_RE.match(text, begin)):
+            pos, kind, val = m.end(), 'en', m.group(1)
+        else:
+            pos, kind = _scan_other(text, begin), 'other'
+        if kind not in ('no_en', 'en'):
+            val = text[begin:pos]
+        yield text[start:pos], kind, val
+
+def _scan_other(text, pos):
+    n = len(text)
+    while pos < n:
+        c = text[pos]
+        if c == '"':
+            m = _STR_RE.match(text, pos)
+        elif c == "'":
+            m = _CHAR_RE.match(text, pos)
+        elif c == '@':
+            m = _VERBATIM_RE.match(text, pos)
+        elif c == '/':
+            if text.startswith('/*', pos) and (end := text.find('*/', pos + 2)) != -1:
+                pos = end + 2
+                continue
+            m = None
+        elif c in '{}' or c.isspace():
+            break
+        else:
+            m = _PLAIN_RE.match(text, pos)
+        # Unbalanced quotes and lone / or @ are taken as is
+        pos = m.end() if m else pos + 1
+    return pos
+
+def parse_nutstr(val):
+    """Value of a squirrel string literal, verbatim or not"""
+    if val.startswith('@'):
+        return val[2:-1].replace('""', '"')
+    return ast.literal_eval(val)
 
 REF_PAIRS = {}
-REF_RULES = defaultdict(list)
+REF_RULES = defaultdict(list)  # Built from REF_RULE_LIST lazily, see _index_rules()
+REF_RULE_LIST = []
 CODE_RULES = defaultdict(str)
 REF_BLOCKS = {}   # en -> block, for all non-silent ref entries; used to report unmatched
 DUP_BLOCKS = []
@@ -283,19 +945,21 @@ def load_ref(ref_file, silent=False):
                                 DUP_CAPTURE_BLOCKS.append(block)
                             if not silent and _bad_pattern_captures(en):
                                 BAD_PATTERN_BLOCKS.append(block)
-                            key = _rule_key(en)
-                            REF_RULES[key].append([_pattern2re(en), en, pair])
+                            REF_RULE_LIST.append((_rule_keys(en), [_pattern2re(en), en, pair]))
+                            REF_RULES.clear()
                         else:
                             REF_PAIRS[en] = pair
+                            if not silent:
+                                FUZZY.add(en, block)
             elif tok == 'code':
                 if level > 0:
                     if not meat:
                         code.append(val)
             elif tok == 'en':
-                en = ast.literal_eval(val)
+                en = parse_nutstr(val)
                 KNOWN_WORDS.update(_iter_keys(en))
             elif tok == 'no_en':
-                no_en = ast.literal_eval(val)
+                no_en = parse_nutstr(val)
                 if no_en not in REF_PAIRS:
                     REF_PAIRS[no_en] = '' if silent else m
                 KNOWN_WORDS.update(_iter_keys(no_en))
@@ -303,6 +967,18 @@ def load_ref(ref_file, silent=False):
                 if level > 0:
                     meat = True
 
+def pack_file():
+    return Path(__file__).resolve().parent / "rosetta" / f'pack_{OPTS["lang"]}.nut'
+
+def load_pack():
+    if (pack := pack_file()).exists():
+        load_ref(str(pack), silent=True)
+
+def reset_ref():
+    for state in (REF_PAIRS, REF_RULES, REF_RULE_LIST, CODE_RULES, REF_BLOCKS, DUP_BLOCKS,
+                  DUP_CAPTURE_BLOCKS, BAD_PATTERN_BLOCKS, KNOWN_WORDS, FUZZY):
+        state.clear()
+
 def _pattern2re(pat):
     def _prepare(p):
         if not p or p[0] != '<':
@@ -332,14 +1008,87 @@ def ref_en(opt):
     if opt in REF_PAIRS:
         return REF_PAIRS[opt]
 
-    if not REF_RULES:
+    if not REF_RULE_LIST:
         return None
+    if not REF_RULES:
+        _index_rules()
 
     for key in _opt_keys(opt):
         for en_re, en, pair in REF_RULES.get(key, ()):
             if re.search(en_re, opt):
                 return pair
 
+def _index_rules():
+    """Puts each rule under its rarest word, same as the runtime does"""
+    freqs = Counter(key for keys, _ in REF_RULE_LIST for key in keys)
+    for keys, rule in REF_RULE_LIST:
+        REF_RULES[min(keys, key=freqs.__getitem__)].append(rule)
+
+
+# Fuzzy matching
+
+class FuzzyIndex:
+    """Finds reference ens similar to a given string, i.e. ones changed a word or two since.
+
+       Candidates are looked up with MinHash LSH over word bigrams,
+       then verified by the word level similarity ratio. Indexed lazily on first lookup."""
+    MIN_WORDS = 5
+    THRESHOLD = 0.8
+    BANDS, ROWS = 16, 2  # 32 16-bit hashes are taken from a single blake2b digest
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.entries = []  # (en, words, block)
+        self.buckets = None
+
+    def add(self, en, block):
+        words = en.split()
+        if len(words) >= self.MIN_WORDS:
+            self.entries.append((en, words, block))
+            self.buckets = None
+
+    def find(self, s):
+        """Returns (similarity, en, block) for the most similar entry or None"""
+        words = s.split()
+        if len(words) < self.MIN_WORDS or not self.entries:
+            return None
+        if self.buckets is None:
+            self._build()
+
+        candidates = {i for band in self._bands(words) for i in self.buckets.get(band, ())}
+        best = None
+        for i in sorted(candidates):
+            en, old_words, block = self.entries[i]
+            ratio = SequenceMatcher(None, old_words, words, autojunk=False).ratio()
+            if ratio >= self.THRESHOLD and (best is None or ratio > best[0]):
+                best = ratio, en, block
+        return best
+
+    def _build(self):
+        self.buckets = defaultdict(list)
+        for i, (_, words, _) in enumerate(self.entries):
+            for band in self._bands(words):
+                self.buckets[band].append(i)
+
+    def _bands(self, words):
+        hashes = [struct.unpack('32H', blake2b(f'{a} {b}'.encode(), digest_size=64).digest())
+                  for a, b in zip(words, words[1:])]
+        sig = list(map(min, zip(*hashes)))
+        for band in range(self.BANDS):
+            yield band, tuple(sig[band * self.ROWS:(band + 1) * self.ROWS])
+
+FUZZY = FuzzyIndex()
+
+def ref_fuzzy(opt):
+    if not (found := FUZZY.find(opt)):
+        return None
+    ratio, en, block = found
+    block = re.sub(fr'\ben\s*=\s*(?:{_STR}|{_VERBATIM})', lambda _: 'en = ' + nutstr(opt), block,
+                   count=1)
+    return f'    // FUZZY {ratio:.0%}: {nutstr(en)}\n' + block.lstrip('\n')
+
 
 NESTED_RE = re.compile(r'\[([^|]+)\|[^]]+\]')
 IMG_RE = re.compile(r'\[img[^\]]*\][^\[]+\[/img\w*\]|\[[^\]]+]')  # img + imgtooltip
@@ -353,20 +1102,21 @@ def _strip_tags(s):
     s = IMG_RE.sub(' ', s)
     return TAGS_RE.sub(' ', s)
 
-def _rule_key(pat):
+def _rule_keys(pat):
     def repl(m):
         prefix, sub, suffix = m.groups()
         return f'{prefix} {suffix}' if sub == 'tag' or sub.endswith('_tag') else ' '
 
     s = PATTERN_KEY_RE.sub(repl, pat)
-    return first(_iter_keys(s))
+    # A rule without words is put under None, _opt_keys() always ends with None to look there
+    return list(dict.fromkeys(_iter_keys(s))) or [None]
 
 def _opt_keys(opt):
     s = re.sub(fr'<[\w.:]*{FORMAT_FUNCS_RE}\(([^)]*)\)>', r' \2 ', opt)
     return chain(_iter_keys(s), [None])
 
 def _iter_keys(s):
-    # TODO: drop partial words same as in _rule_key?
+    # TODO: drop partial words adjacent to captures same as in _rule_keys()?
     s = re.sub(r'<\w[^>]*>|%[sdif]|%', ' ', s)  # strip rosetta captures, html tags, %s, %d
     words = _strip_tags(s).lower().strip().split()
     for w in words:
@@ -379,28 +1129,64 @@ def _iter_keys(s):
 FILES_SKIP_RE = re.compile(
     r'(\b|_)(rosetta(\w+)?|mocks|test|hack_msu)(\b|[_.-])|(?:^|[/\\])(!!redirect|~~finalize)')
 
+# Mod data dirs, these are only pruned outside of scripts/, which has its own ui/
+DATA_DIRS = {"gfx", "sounds", "music", "brushes", "ui"}
+
+def iter_mod_files(path, on_skip=None, _in_scripts=None):
+    """Walks .nut files in the sorted(path.glob("**/*.nut")) order, pruning skipped dirs early"""
+    path = Path(path)
+    if _in_scripts is None:
+        _in_scripts = _is_in_scripts(path)
+
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        if entry.is_dir():
+            if FILES_SKIP_RE.search(entry.path + os.sep) \
+                    or not _in_scripts and entry.name in DATA_DIRS:
+                skip = True
+            else:
+                yield from iter_mod_files(entry.path, on_skip, _in_scripts or entry.name == "scripts")
+                continue
+        elif entry.name.endswith(".nut") and entry.is_file():
+            skip = FILES_SKIP_RE.search(entry.path)
+            if not skip:
+                yield Path(entry.path)
+                continue
+        else:
+            continue
+
+        if not OPTS["quiet"]:
+            print(yellow("SKIPPING: %s" % entry.path), file=sys.stderr)
+        if on_skip:
+            on_skip(entry.path)
+
+def _is_in_scripts(path):
+    """Tells if path is in scripts/ of the nearest mod root, i.e. a dir that has scripts/ in it,
+       a scripts dir higher up, like the one in ~/scripts/some_mod, doesn't count"""
+    path = path.resolve()
+    for parent in [path, *path.parents]:
+        if (parent / "scripts").is_dir():
+            return path.is_relative_to(parent / "scripts")
+    return False
+
 def extract_path(path, out=print):
     path = Path(path)
     if path.is_dir():
         extract_dir(path, out)
     elif path.is_file():
-        out(NUT_HEADER.format(**OPTS))
+        _out_header(out)
         extract_file(path, out)
-        out(NUT_FOOTER)
+        _out_footer(out)
     else:
         exit("File not found: " + str(path))
 
 def extract_dir(path, out=print):
-    count, skipped, failed = 0, 0, 0
-    out(NUT_HEADER.format(**OPTS))
-
-    for subfile in sorted(path.glob("**/*.nut")):
-        if FILES_SKIP_RE.search(str(subfile)):
-            if not OPTS["quiet"]:
-                print(yellow("SKIPPING: %s" % subfile), file=sys.stderr)
-            skipped += 1
-            continue
+    count, failed = 0, 0
+    skipped = []
+    _out_header(out)
 
+    for subfile in iter_mod_files(path, on_skip=skipped.append):
         if not OPTS["quiet"]:
             print(yellow("FILE: %s" % subfile), file=sys.stderr)
         try:
@@ -414,20 +1200,42 @@ def extract_dir(path, out=print):
 
         count += 1
 
-    out(NUT_FOOTER)
+    _out_footer(out)
     print(green(f"Processed {count} files"
-        + (f", skipped {skipped}" if skipped else "")
+        + (f", skipped {len(skipped)}" if skipped else "")
         + (f", failed {failed}" if failed else "")),
           file=sys.stderr)
 
+def _out_header(out):
+    if OPTS["format"] == "nut":
+        out(NUT_HEADER.format(**OPTS))
+
+def _out_footer(out):
+    if OPTS["format"] == "nut":
+        out(NUT_FOOTER)
+
+DONE_FILES = {}  # filename -> (output, state), files done in a resumed -t run
+
 def extract_file(filename, out):
+    if (done := DONE_FILES.get(str(filename))) is not None:
+        _restore_file(out, *done)
+        return
+
     with open(filename, encoding='utf8') as fd:
         code = fd.read()
 
+    if OPTS["format"] == "jsonl":
+        # Stream as found, this is for tools, so no -t here
+        for cand in iter_candidates(code):
+            if pair := extract_pair(cand):
+                out(_jsonl(pair, cand, filename))
+        return
+
+    if OPTS["engine"]:
+        state_before = _file_state()
     pairs = list(extract(code, filename=filename))
 
-    if pairs:
-        out("    // FILE: %s" % filename)
+    lines = ["    // FILE: %s" % filename] if pairs else []
 
     if OPTS["engine"]:
         import xt
@@ -436,10 +1244,140 @@ def extract_file(filename, out):
         ens = [p["en"] for p in todo]
         rus = xt.translate(OPTS["engine"], ens)
         for p, ru in zip(todo, rus):
-            p[OPTS["lang"]] = ru
+            p[OPTS["lang"]] = ru or ''
+
+    lines.extend(_format(pair) for pair in pairs)
+    for line in lines:
+        out(line)
+
+    # Checkpoint fully translated files, so that these are not redone on --resume
+    if OPTS["engine"] and xt.RUN and None not in rus:
+        seen, code_keys = _file_state()
+        state = {"seen": sorted(seen - state_before[0]), "code": sorted(state_before[1] - code_keys)}
+        xt.run_file_done(filename, "\n".join(lines), state)
+
+def _jsonl(pair, cand, filename):
+    lang = OPTS["lang"]
+    if isinstance(pair, str):
+        value = re_find(fr'^\s*{lang}\s*=\s*({_STR}|{_VERBATIM})', pair, re.M)
+        mode = re_find(r'^\s*mode\s*=\s*"(\w+)"', pair, re.M)
+        value = parse_nutstr(value) if value else None
+    else:
+        value, mode = pair[lang], pair.get("mode")
+    return json.dumps({"file": str(filename), "line": cand.line, "en": cand.opt, "mode": mode,
+                       lang: value, "code": cand.code, "context": cand.context,
+                       "ref": isinstance(pair, str)}, ensure_ascii=False)
+
+def _file_state():
+    """Extraction state shared between files: seen strings and yet unused code refs"""
+    return set(SEEN), {key for key, pair in CODE_RULES.items() if pair}
+
+def _restore_file(out, output, state):
+    if output:
+        out(output)
+    SEEN.update(state["seen"])
+    for key in state["code"]:
+        CODE_RULES[key] = ''
+
+# Bootstrapping from an old replacement-style translation, see docs/old-plan.md
+
+OLD_AMBIGUOUS_HEADER = """\
+    // Strings extracted for this context from the translated version of the mod.
+    // Cannot automatically tell which of them correspond to which English phrases above."""
+
+def extract_old(path, old_path, out=print):
+    from concurrent.futures import ProcessPoolExecutor
+
+    en_files, old_files = _mod_files(path), _mod_files(old_path)
+    if set(en_files) != set(old_files):
+        diff = sorted(set(en_files) ^ set(old_files))
+        exit("Mod files differ, are these the same version? I.e. %s" % ", ".join(diff[:5]))
+
+    names = sorted(en_files)
+    jobs = ((name, en_files[name], old_files[name]) for name in names)
+    count, failed = 0, 0
+    out(NUT_HEADER.format(**OPTS))
+    with ProcessPoolExecutor() as executor:
+        for name, en_cands, old_cands in executor.map(_collect_old, jobs, chunksize=16):
+            count += 1
+            if isinstance(en_cands, str):
+                if OPTS["failfast"]:
+                    exit(en_cands)
+                warn(en_cands)
+                failed += 1
+                continue
+            lines = list(_match_old(name, en_cands, old_cands))
+            if lines:
+                out("    // FILE: %s" % name)
+                for line in lines:
+                    out(line)
+    out(NUT_FOOTER)
+    print(green(f"Processed {count} files" + (f", failed {failed}" if failed else "")),
+          file=sys.stderr)
+
+def _mod_files(path):
+    """Returns {root-relative name: contents} for .nut files in a mod dir or zip"""
+    path = Path(path)
+    if path.is_dir():
+        if not (path / "scripts").is_dir():
+            exit(f"No scripts/ in {path}, please point to the mod root")
+        return {f.relative_to(path).as_posix(): f.read_bytes() for f in iter_mod_files(path)}
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            names = zf.namelist()
+            if not any(name.startswith("scripts/") for name in names):
+                exit(f"No scripts/ in {path}, please point to the mod root")
+            return {name: zf.read(name) for name in names
+                    if name.endswith(".nut") and not FILES_SKIP_RE.search(name)}
+    else:
+        exit("File not found: " + str(path))
+
+def _collect_old(job):
+    """Collects candidates for a file pair, runs in a worker process"""
+    name, en_code, old_code = job
+    try:
+        return name, list(iter_candidates(en_code.decode('utf8'))), \
+            list(iter_candidates(old_code.decode('utf8')))
+    except Exception:
+        import traceback
+        return name, f"{name}: {traceback.format_exc()}", None
+
+def _match_old(name, en_cands, old_cands):
+    old_by_context = defaultdict(list)
+    for cand in old_cands:
+        old_by_context[cand.context].append(cand.opt)
+    en_counts = Counter(cand.context for cand in en_cands)
+
+    out, last, index = [], {}, Counter()
+    for cand in en_cands:
+        olds = old_by_context[cand.context]
+        tr = olds[index[cand.context]] if len(olds) == en_counts[cand.context] else ''
+        index[cand.context] += 1
+        if pair := extract_pair(cand, tr):
+            last[cand.context] = len(out)
+            out.append(_format(pair))
+
+    # Put unmatched old strings after the last pair of each ambiguous context
+    comments = {}
+    for context in sorted(en_counts.keys() | old_by_context.keys()):
+        en_count, olds = en_counts[context], old_by_context[context]
+        if en_count == len(olds):
+            continue
+        emitted = bool(olds) and context in last
+        if emitted:
+            comments[last[context]] = "\n".join(
+                [OLD_AMBIGUOUS_HEADER] + ["    // " + nutstr(s) for s in olds])
+        if not OPTS["quiet"]:
+            print(yellow(f"parallel: {name} {context}: {en_count} original strings, "
+                         f"{len(olds)} old strings"
+                         + (", emitted old candidates as comments" if emitted else "")),
+                  file=sys.stderr)
+
+    for i, block in enumerate(out):
+        yield block
+        if i in comments:
+            yield comments[i]
 
-    for pair in pairs:
-        out(_format(pair))
 
 def _format(d):
     if isinstance(d, str):
@@ -544,6 +1482,14 @@ class ContextTracker:
 SEEN = set()
 
 def extract(code, filename=None):
+    for cand in iter_candidates(code):
+        if pair := extract_pair(cand):
+            yield pair
+
+Candidate = namedtuple("Candidate", "opt op code context line")
+
+def iter_candidates(code):
+    """Yields all string candidates in code, doesn't look at SEEN or refs"""
     stream = TokenStream(code)
     context = ContextTracker(stream.clone())  # iterates independently
     lines = code.splitlines()
@@ -562,39 +1508,47 @@ def extract(code, filename=None):
                 continue
             opt = str_opt(opt)
 
-            seen_key = re.sub(r'\d+', '1', opt)  # TODO: only in <expr>
-            if seen_key in SEEN: continue
-            SEEN.add(seen_key)
-
-            code, pair = None, None
+            code = None
             if expr.op != 'str' or '<' in opt or '%s' in opt:
                 # A single token expr leaves the stream on it, so peek(-1) points before its line
                 code = lines[expr.n - 1:max(expr.n, stream.peek(-1).n)]
-                pair = ref_code(code)
-                if pair is None:
-                    pair = ref_en(opt)
-                    if pair not in {None, ''}:
-                        pair = _refresh_code(pair, code)
-            else:
-                pair = ref_en(opt)
+            yield Candidate(opt, expr.op, code, context.get_context(), expr.n)
 
-            if pair is not None:
-                if pair != '':
-                    yield pair
-                continue
+        stream.chop()
 
-            # TODO: better expr detection
-            pair = {"mode": "pattern"} if expr.op != 'str' and '<' in opt or '%s' in opt else {}
-            pair |= {"en": opt, OPTS["lang"]: ''}
-            if code:
-                pair["_code"] = code
-            if OPTS['context']:
-                pair["_context"] = context.get_context()
+def extract_pair(cand, tr=''):
+    """Makes a pair for a candidate, returns a ref block if any, None for seen or skipped ones"""
+    opt, code = cand.opt, cand.code
+    seen_key = re.sub(r'\d+', '1', opt)  # TODO: only in <expr>
+    if seen_key in SEEN: return None
+    SEEN.add(seen_key)
+
+    if code is not None:
+        pair = ref_code(code)
+        if pair is None:
+            pair = ref_en(opt)
+            if pair not in {None, ''}:
+                pair = _refresh_code(pair, code)
+    else:
+        pair = ref_en(opt)
 
-            debug(_format(pair))
-            yield pair
+    # Reuse translation of a slightly changed string
+    if pair is None and '<' not in opt and (pair := ref_fuzzy(opt)) and code:
+        pair = _refresh_code(pair, code)
 
-        stream.chop()
+    if pair is not None:
+        return pair or None
+
+    # TODO: better expr detection
+    pair = {"mode": "pattern"} if cand.op != 'str' and '<' in opt or '%s' in opt else {}
+    pair |= {"en": opt, OPTS["lang"]: tr}
+    if code:
+        pair["_code"] = code
+    if OPTS['context']:
+        pair["_context"] = cand.context
+
+    debug(_format(pair))
+    return pair
 
 
 def extract_expr(stream, lines):
@@ -4,38 +4,42 @@
 local def = ::Rosetta, mod = def.mh, _ = def._;
 local Table = ::std.Table, Str = ::std.Str;
 
-local simpleGetter = @(__original) function () {
-    return _(__original());
-}
-local function makeGetter(_field) {
-    return @(__original) function () {
-        local script = IO.scriptFilenameByHash(this.ClassNameHash);
-        return _(__original(), script + "." + _field);
-    }
+// Hooks are wrapped for profiling when they are set, so it costs nothing otherwise,
+// see def.profiled()
+local function profiled(_name, _hook) {
+    if (!def.profiling) return _hook;
+    return @(__original) def.profiled(_name, _hook(__original));
 }
 
 mod.queue("<mod_msu", function () {
+    if (def.profiling) {
+        def.translate = def.profiled("translate", def.translate);
+        def._ = def.translate.bindenv(def);
+        _ = def._;
+    }
+
     mod.hook("scripts/items/item", function (q) {
-        // q.getName = simpleGetter;
-        q.getDescription = makeGetter("Description");
+        // q.getName = def.simpleGetter("getName");
+        q.getDescription = profiled("item.getDescription",
+            def.idGetter("getDescription", "Description"));
     })
     mod.hook("scripts/skills/skill", function (q) {
-        // q.getName = simpleGetter;
-        q.getDescription = makeGetter("Description");
+        // q.getName = def.simpleGetter("getName");
+        q.getDescription = profiled("skill.getDescription",
+            def.idGetter("getDescription", "Description"));
     })
 
     // Need to hook earlier because if Nested Tooltips messing these
     mod.hookTree("scripts/entity/tactical/actor", function (q) {
-        q.getNameOnly = simpleGetter;
-        q.getKilledName = simpleGetter;
-        q.getTitle = simpleGetter;
-        q.getName = @(__original) function () {
-            local ret = __original();
+        q.getNameOnly = profiled("actor.getNameOnly", def.simpleGetter("getNameOnly"));
+        q.getKilledName = profiled("actor.getKilledName", def.simpleGetter("getKilledName"));
+        q.getTitle = profiled("actor.getTitle", def.simpleGetter("getTitle"));
+        q.getName = profiled("actor.getName", def.cachedGetter("getName", function (_str) {
             // Allow translating name and title separately
             local vanilla = m.Title == "" ? m.Name : m.Name + " " + m.Title;
-            if (ret == vanilla) return m.Title == "" ? _(m.Name) : _(m.Name) + " " + _(m.Title);
-            return _(ret);
-        }
+            if (_str == vanilla) return m.Title == "" ? _(m.Name) : _(m.Name) + " " + _(m.Title);
+            return _(_str);
+        }))
     })
 })
 
@@ -77,27 +81,27 @@ mod.queue(">mod_msu", function () {
     // Hooks
     mod.hook("scripts/ui/screens/tactical/modules/topbar/tactical_screen_topbar_event_log",
             function (q) {
-        q.log = q.logEx = @(__original) function (_text) {
+        q.log = q.logEx = profiled("event_log.log", @(__original) function (_text) {
             __original(_(_text))
-        }
+        })
     })
 
     // Popup dialogs (single chokepoint for tactical/world/campfire showDialogPopup)
     mod.hook("scripts/ui/screens/dialog_screen", function (q) {
-        q.show = @(__original) function (_title, _text, _doneCallback, _okCallback = null, _cancelCallback = null, _isMonologue = false) {
+        q.show = profiled("dialog_screen.show", @(__original) function (_title, _text, _doneCallback, _okCallback = null, _cancelCallback = null, _isMonologue = false) {
             return __original(_(_title), _(_text), _doneCallback, _okCallback, _cancelCallback, _isMonologue);
-        }
+        })
     })
 
     // Perks
     mod.hook("scripts/ui/global/data_helper", function (q) {
-        q.convertEntityToUIData = @(__original) function (_entity, _activeEntity) {
+        q.convertEntityToUIData = profiled("convertEntityToUIData", @(__original) function (_entity, _activeEntity) {
             local result = __original(_entity, _activeEntity);
             if ("necro_perkTree" in result) {
                 result.necro_perkTree = def.translatePerkTree(result.necro_perkTree);
             }
             return result;
-        }
+        })
     })
 
     local Perks_findById = ::Const.Perks.findById;
@@ -105,10 +109,10 @@ mod.queue(">mod_msu", function () {
         return def.translatePerk(Perks_findById(_id));
     }
 
-    local tooltipHook = @(__original) function (...) {
+    local tooltipHook = profiled("tooltipHook", @(__original) function (...) {
         vargv.insert(0, this);
         return def.translateTooltip(__original.acall(vargv));
-    }
+    })
 
     // Tooltips
     mod.hook("scripts/ui/screens/tooltip/tooltip_events", function (q) {
@@ -128,39 +132,42 @@ mod.queue(">mod_msu", function () {
 
     // Background
     mod.hook("scripts/skills/backgrounds/character_background", function (q) {
-        q.getName = @(__original) function () {
+        q.getName = profiled("background.getName", @(__original) function () {
             local ret = __original();
             local parts = Str.split(": ", ret, 1);
             if (parts.len() == 2) return parts[0] + ": " + _(parts[1]);
             return ret;
-        }
-        q.getNameOnly = simpleGetter;
+        })
+        q.getNameOnly = profiled("background.getNameOnly", def.simpleGetter("getNameOnly"));
     })
     mod.hookTree("scripts/skills/backgrounds/character_background", function (q) {
-        q.onBuildDescription = @(__original) function () {
-            local script = IO.scriptFilenameByHash(this.ClassNameHash);
-            return _(__original(), script + ".onBuildDescription");
-        }
+        q.onBuildDescription = profiled("background.onBuildDescription",
+            def.idGetter("onBuildDescription", "onBuildDescription"));
     })
 
     mod.hookTree("scripts/entity/tactical/entity", function (q) {
-        if (!q.ClassName == "actor" && !q.contains("actor", true)) q.getName = simpleGetter;
-        q.getDescription = makeGetter("Description");
+        if (!q.ClassName == "actor" && !q.contains("actor", true))
+            q.getName = profiled("entity.getName", def.simpleGetter("getName"));
+        q.getDescription = profiled("entity.getDescription",
+            def.idGetter("getDescription", "Description"));
     })
     mod.hookTree("scripts/items/item", function (q) {
-        q.getName = simpleGetter;
-        q.getDescription = makeGetter("Description");
+        q.getName = profiled("item.getName", def.simpleGetter("getName"));
+        q.getDescription = profiled("item.getDescription",
+            def.idGetter("getDescription", "Description"));
     })
     mod.hookTree("scripts/skills/skill", function (q) {
-        q.getName = simpleGetter;
-        q.getDescription = makeGetter("Description");
+        q.getName = profiled("skill.getName", def.simpleGetter("getName"));
+        q.getDescription = profiled("skill.getDescription",
+            def.idGetter("getDescription", "Description"));
     })
     mod.hookTree("scripts/scenarios/world/starting_scenario", function (q) {
-        q.getName = makeGetter("Name");
-        q.getDescription = makeGetter("Description");
+        q.getName = profiled("scenario.getName", def.idGetter("getName", "Name"));
+        q.getDescription = profiled("scenario.getDescription",
+            def.idGetter("getDescription", "Description"));
     })
     mod.hook("scripts/contracts/contract", function (q) {
-        q.getUITitle = simpleGetter;
+        q.getUITitle = profiled("contract.getUITitle", def.simpleGetter("getUITitle"));
         q.getUIButtons = tooltipHook;
     })
 
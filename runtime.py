@@ -0,0 +1,671 @@
+#!/usr/bin/env python3
+"""\
+Usage:
+    python runtime.py <pair-file>... [options] < <strings-file>
+
+Python port of the Rosetta runtime, translates strings the same way the game does.
+
+Arguments:
+    <pair-file>     Translation file(s) calling ::Rosetta.add(), i.e. rosetta_ru.nut
+    <strings-file>  Strings to translate, one per line, \\n is unescaped
+
+Options:
+    -l<lang>        Language to activate, defaults to ru
+    -h, --help      Show this help
+"""
+# This mirrors scripts/!mods_preload/!rosetta.nut: Rosetta.add(), translate(), matchParts(),
+# useRule(), plural(), _ruleKey() and _iterKeys() are ported closely, keeping names and quirks,
+# so that both could be checked against the same cases in test_cases.nut.
+# Rules with use = function () {...} are squirrel code, so these are loaded but never applied.
+# Not ported: hooks and logging.
+import ast
+import re
+import sys
+from collections import Counter, namedtuple
+from pathlib import Path
+
+
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv:
+        print(__doc__)
+        return
+
+    lang, files = "ru", []
+    for arg in sys.argv[1:]:
+        if arg.startswith("-l"):
+            lang = arg[2:]
+        else:
+            files.append(arg)
+    if not files:
+        exit("Please specify pair file(s)")
+
+    rosetta = Rosetta()
+    rosetta.activate(lang)
+    for file in files:
+        rosetta.load(file, lang=lang)
+    for line in sys.stdin:
+        s = line.rstrip("\n").replace("\\n", "\n")
+        print(rosetta.translate(s).replace("\n", "\\n"))
+
+def exit(message):
+    print(message, file=sys.stderr)
+    sys.exit(1)
+
+
+# Runtime
+
+class RosettaError(Exception):
+    pass
+
+
+class Lang(namedtuple("Lang", "name forms fallback choose")):
+    __slots__ = ()
+
+def _ru_plural(n):
+    return 1 if n % 10 == 1 and n % 100 != 11 \
+        else 2 if 2 <= n % 10 <= 4 and (n % 100 < 12 or n % 100 > 14) else 5
+
+LANGS = {
+    "ru": Lang("Русский", [1, 2, 5], 5, _ru_plural),
+    "es": Lang("Español", [1, 2], 2, lambda n: 1 if n == 1 else 2),
+    "ja": Lang("日本語", None, None, None),
+    "zh_CN": Lang("简体中文", None, None, None),
+}
+
+# img + imgtooltip + reforged refs + bbcode + HTML entities + HTML tags
+TAGS_RE = re.compile(r"\[img[^\]]*\][^\[]+\[/img\w*\]|\[[0-9=]+\][^\[]+\.png\[/[0-9=]+\]"
+                     r"|\[[^\]]+]|&\w+;|<[^>]+>", re.A)
+# drop partial words adjacent to patterns
+PATTERN_KEY_RE = re.compile(r"([\w!-;?-~]*)<\w+:(\w+)>([\w!-;?-~]*)", re.A)
+STOP = set("a the of in at to as is be are do has have having not and or"
+           " it it's its this that he she his her him ah eh , .".split())
+KEY_SPLIT_RE = re.compile(r"[ \n]+")
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+PATTERN_RE = re.compile(r"([^<]+)|<(\w+):(\w+)>", re.A)
+REPLACE_PART_RE = re.compile(r"([^<]+)|<(\w+)(?::(\w+))?>", re.A)
+
+def _sub_res():
+    open, close = r"\[[^\]]+\]", r"\[/[^\]]+\]"
+    res = {
+        "int": r"[+\-]?\d+",
+        "val": r"[+\-]?\d+(?:\.\d+)?%?",
+        "word": r"[^ \t\n,.:;!\[\]()]+",
+        "str": r"[^\[\]]*",  # Not used in match_parts(), same as in runtime
+        "line": r"[^\n]*(?:\n|\Z)",
+        "tag": open,
+        "img": r"\[img\][^\]]+\[/img\]",
+    }
+    for key in ["int", "val", "str"]:
+        res[key + "_tag"] = open + res[key] + close
+    return {key: re.compile(val, re.A) for key, val in res.items()}
+
+SUB_RES = _sub_res()
+
+Capture = namedtuple("Capture", "name sub")
+Sub = namedtuple("Sub", "name flags")
+
+WORD_RE = re.compile(r"[a-zA-Z][a-zA-Z]")
+JUNK_RE = re.compile(r"Reforged|MSU Dummy Player Background|MSU|SendLog|%\w+%", re.A)
+INT_RE = re.compile(r"[+\-]?\d+")
+
+
+class Rosetta:
+    def __init__(self):
+        self.langs = dict(LANGS)
+        self.active = None
+        self.maps = {}
+        self.stats = {"hits": 0, "misses": 0, "rule_hits": 0, "rule_uses": 0}
+
+    def activate(self, lang):
+        if lang not in self.langs:
+            raise RosettaError(f"Language {lang} is not registered")
+        self.active = lang
+
+    def load(self, file, lang=None):
+        """Adds pairs from a translation file the same way the game does when it runs it.
+           lang is used when translation description is not a literal in the file."""
+        self.load_text(Path(file).read_text(encoding="utf-8"), lang=lang, name=str(file))
+
+    def load_text(self, text, lang=None, name="<text>"):
+        nut = parse_nut(text)
+        for call in nut.calls:
+            if len(call.args) != 2:
+                continue
+            desc, pairs = map(nut.resolve, call.args)
+            if not isinstance(desc, dict):
+                desc = {"mod": {"id": name}, "lang": lang or self.active}
+            if call.name == "add":
+                self.add(desc, pairs)
+            else:
+                self.add_compiled(desc, pairs)
+
+    def add(self, desc, pairs):
+        lang = desc["lang"]
+        if lang not in self.langs:
+            raise RosettaError(
+                f"Please register your language with ::Rosetta.addLang({lang}, ...) first")
+
+        amap = self.maps.setdefault(lang, self._new_map())
+        strs, ids = amap["strs"], amap["ids"]
+        for pair in pairs:
+            if not self.validate_pair(lang, pair):
+                continue
+
+            mode = pair.get("mode", "str")
+            if mode == "pattern" or "plural" in pair or "split" in pair:
+                rule = self.make_rule(lang, pair)
+                rule["keys"] = self._rule_keys(pair["en"])
+                amap["ruleList"].append(rule)
+                amap["dirty"] = True
+            else:
+                if "id" in pair: ids[pair["id"]] = pair[lang]
+                if "en" in pair: strs[pair["en"]] = pair[lang]
+
+    def add_compiled(self, desc, compiled):
+        """Adds pairs precompiled by rosetta.py --compile, same as addCompiled() in the mod"""
+        lang = desc["lang"]
+        if lang not in self.langs:
+            raise RosettaError(
+                f"Please register your language with ::Rosetta.addLang({lang}, ...) first")
+
+        amap = self.maps.setdefault(lang, self._new_map())
+        amap["strs"].update(compiled["strs"])
+        amap["ids"].update(compiled["ids"])
+        if compiled["rules"]:
+            amap["ruleList"].extend(self._load_rule(lang, r) for r in compiled["rules"])
+            amap["dirty"] = True
+
+    @staticmethod
+    def _new_map():
+        return {"strs": {}, "ids": {}, "rules": {}, "ruleList": [], "dirty": False}
+
+    @staticmethod
+    def _build_rules(amap):
+        """Puts each rule into the bucket of its rarest word, same as _buildRules()"""
+        freqs = Counter(key for rule in amap["ruleList"] for key in rule["keys"])
+        rules = {}
+        for rule in amap["ruleList"]:
+            best = min(rule["keys"], key=freqs.__getitem__)  # first of the rarest
+            rules.setdefault(best, []).append(rule)
+        amap["rules"], amap["dirty"] = rules, False
+
+    @staticmethod
+    def _load_rule(lang, rule):
+        rule = dict(rule)
+        rule["parts"] = [p if isinstance(p, str) else Capture(p["name"], p["sub"])
+                         for p in rule["parts"]]
+        for key, val in rule.items():
+            if key == lang or len(key) == 2 and key[0] == "n":
+                rule[key] = [p if isinstance(p, str) else Sub(p["name"], p["flags"] or "")
+                             for p in val]
+        return rule
+
+    def validate_pair(self, lang, pair):
+        if "en" not in pair and "id" not in pair:
+            raise RosettaError(f"No en nor id in Rosetta pair: {pair!r}")
+
+        lang_def = self.langs[lang]
+
+        if pair.get("mode") == "pattern" or "plural" in pair:
+            if "id" in pair:
+                raise RosettaError('Can\'t use mode="pattern" or plural with id')
+
+        if "plural" in pair:
+            empty = False
+            for n in lang_def.forms:
+                key = f"n{n}"
+                if key not in pair:
+                    raise RosettaError(f"No {key} in Rosetta pair: {pair!r}")
+                if pair[key] == "":
+                    empty = True
+            if empty:
+                return False
+        elif "split" in pair or "use" in pair:
+            return True
+        else:
+            if lang not in pair:
+                raise RosettaError(f"No {lang} in Rosetta pair: {pair!r}")
+            if pair[lang] == "":
+                return False  # Not loading pairs with empty translations
+
+        return True
+
+    @staticmethod
+    def _strip_tags(s):
+        return TAGS_RE.sub(" ", s)
+
+    def _rule_keys(self, pat):
+        def repl(m):
+            prefix, sub, suffix = m.groups()
+            return prefix + " " + suffix if sub == "tag" or sub.endswith("_tag") else ""
+
+        keys = list(dict.fromkeys(self._iter_keys(PATTERN_KEY_RE.sub(repl, pat))))
+        return keys[:-1] if len(keys) > 1 else keys  # "" only if there is nothing else
+
+    def _iter_keys(self, s):
+        words = KEY_SPLIT_RE.split(self._strip_tags(s).translate(ASCII_LOWER).strip())
+        # skip stop words, numbers and control chars
+        for w in words:
+            if w and w not in STOP and (" " < w[0] < "0" or w[0] > "9"):
+                yield w
+        yield ""
+
+    def make_rule(self, lang, pair):
+        rule = dict(pair)
+        rule["parts"] = self.parse_pattern(pair["en"])
+        for key, val in pair.items():
+            if key == lang or len(key) == 2 and key[0] == "n":
+                rule[key] = self.parse_replacement(val)
+        self.validate_rule(lang, rule)
+        self._add_prefilter(rule)
+        return rule
+
+    @staticmethod
+    def _add_prefilter(rule):
+        # Lengths are in bytes as in squirrel, so that compiled rules are the same
+        min_len, prefix, suffix, literal = 0, "", "", ""
+        last = len(rule["parts"]) - 1
+        for i, p in enumerate(rule["parts"]):
+            if not isinstance(p, str):
+                continue
+            min_len += len(p.encode())
+            if i == 0:
+                prefix = p
+            elif i == last:
+                suffix = p
+            elif len(p.encode()) > len(literal.encode()):
+                literal = p
+        rule.update(minLen=min_len, prefix=prefix, suffix=suffix, literal=literal)
+
+    @staticmethod
+    def parse_pattern(pat):
+        return [text if text else Capture(name, sub)
+                for text, name, sub in PATTERN_RE.findall(pat)]
+
+    @staticmethod
+    def parse_replacement(s):
+        return [text if text else Sub(name, flags)
+                for text, name, flags in REPLACE_PART_RE.findall(s)]
+
+    def validate_rule(self, lang, rule):
+        labels = set()
+        for p in rule["parts"]:
+            if isinstance(p, str):
+                continue
+            if p.name in labels:
+                raise RosettaError(f"Duplicate capture '{p.name}' in 'en' in {rule['en']!r}")
+            labels.add(p.name)
+
+        if "plural" in rule and rule["plural"] not in labels:
+            raise RosettaError(f"Plural label is not in 'en' in {rule['en']!r}")
+
+        for i, part in enumerate(rule["parts"]):
+            if isinstance(part, str):
+                continue
+            if part.sub not in SUB_RES:
+                raise RosettaError(f"Label type '{part.sub}' is not supported in {rule['en']!r}")
+            prev = rule["parts"][i - 1] if i > 0 else None
+            if part.sub == "str" and isinstance(prev, Capture) and prev.sub == "str":
+                raise RosettaError(f"Two :str next to each other not allowed in {rule['en']!r}")
+
+        for key, val in rule.items():
+            if not (key == lang or key[0] == "n" and len(key) == 2):
+                continue  # output keys
+            for p in val:
+                if isinstance(p, Sub) and p.name not in labels:
+                    raise RosettaError(
+                        f"Label '{p.name}' is in '{key}' but not in 'en' in {rule['en']!r}")
+
+    def _clean(self, s):
+        return self._strip_tags(JUNK_RE.sub("", s)).strip()
+
+    def _is_interesting(self, s):
+        return WORD_RE.search(self._clean(s)) is not None
+
+    def tap(self, s, id, value, rule=False):
+        stats_key = ("rule_hits" if rule else "hits") if value else "misses"
+        self.stats[stats_key] += 1
+        return value if value else s
+
+    def translate(self, s, id=None, skip_rule=None):
+        if self.active is None or not isinstance(s, str):
+            return s
+
+        ret, amap = None, self.maps.get(self.active)
+        if amap is None:
+            return self.tap(s, id, None)
+        if id is not None and id in amap["ids"]:
+            ret = amap["ids"][id]
+        elif s in amap["strs"]:
+            ret = amap["strs"][s]
+        if ret:
+            return self.tap(s, id, ret)
+
+        self.stats["rule_uses"] += 1
+        # Look for pattern
+        if amap["dirty"]:
+            self._build_rules(amap)
+        for key in self._iter_keys(s):
+            for rule in amap["rules"].get(key, ()):
+                if rule is skip_rule:
+                    continue  # Protect against split rule stack overflow
+                ret = self.try_rule(rule, s)
+                if ret is None:
+                    continue
+                return self.tap(s, id, ret, True)
+        return self.tap(s, id, None, True)
+
+    def try_rule(self, rule, s):
+        if not (s.startswith(rule["prefix"]) and s.endswith(rule["suffix"])
+                and rule["literal"] in s):
+            return None
+        matches = self.match_parts(s, rule["parts"])
+        return None if matches is None else self.use_rule(rule, s, matches)
+
+    def use_rule(self, rule, s, matches):
+        if "split" in rule:
+            return self.use_split(rule, rule["split"], s)
+        elif "use" in rule:
+            return None  # Squirrel function, can't run it here
+
+        to = f"n{self.plural(matches[rule['plural']])}" if "plural" in rule else self.active
+        ret = ""
+        for p in rule[to]:
+            if isinstance(p, str):
+                ret += p
+            else:
+                t = matches[p.name]
+                if p.flags == "t":
+                    tt = self.translate(t)
+                    if tt == t and self._is_interesting(t):
+                        return None
+                    t = tt
+                ret += t
+        return ret
+
+    def use_split(self, rule, sep, s):
+        return sep.join(self.translate(p, None, rule) for p in s.split(sep))
+
+    def match_parts(self, s, parts):
+        """Same walk as in matchParts(), see comments there.
+           Returns captures dict or None, note that empty dict means a match."""
+        pos, matches = 0, {}
+        sn = len(s)
+        for i, p in enumerate(parts):
+            if isinstance(p, str):
+                pn = len(p)
+                if pos + pn > sn or s[pos:pos + pn] != p:
+                    return None
+                pos += pn
+            elif p.sub != "str":
+                m = SUB_RES[p.sub].search(s, pos)
+                if m is None or m.start() != pos:
+                    return None
+                matches[p.name] = m.group()
+                pos = m.end()
+            else:
+                if i == len(parts) - 1:
+                    matches[p.name] = s[pos:]
+                    return matches
+                next = parts[i + 1]
+                if not isinstance(next, str):
+                    assert next.sub != "str", "Should be prevented by rule validation"
+                    regex = SUB_RES[next.sub]
+
+                np = pos
+                while True:
+                    # We look matches from left to right, this makes <...:str> non-greedy
+                    if isinstance(next, str):
+                        np = s.find(next, np)
+                        if np == -1:
+                            return None
+                        begin, end = np, np + len(next)
+                    else:
+                        m = regex.search(s, np)
+                        if not m:
+                            return None
+                        begin, end = m.start(), m.end()
+                        np = begin
+
+                    tail_matches = self.match_parts(s[end:], parts[i + 2:])
+                    if tail_matches is not None:
+                        matches[p.name] = s[pos:np]
+                        if not isinstance(next, str):
+                            matches[next.name] = s[begin:end]
+                        matches.update(tail_matches)
+                        return matches
+                    np += 1
+        return matches if pos == sn else None
+
+    def plural(self, s):
+        lang = self.langs[self.active]
+        for n in (s, self._strip_tags(s).strip()):
+            if INT_RE.fullmatch(n.strip()):
+                return lang.choose(int(n))
+        return lang.fallback
+
+
+# Squirrel files
+
+NutFunction = namedtuple("NutFunction", "source")  # function literals, not evaluated
+NutExpr = namedtuple("NutExpr", "source")          # references and other non-literals
+NutCall = namedtuple("NutCall", "name pos args spans")
+
+class NutFile(namedtuple("NutFile", "vars spans calls")):
+    __slots__ = ()
+
+    def resolve(self, arg):
+        return self.vars.get(arg.source, arg) if isinstance(arg, NutExpr) else arg
+
+class NutSyntaxError(Exception):
+    pass
+
+_SKIP_RE = re.compile(r'(?:\s+|//[^\n]*|#[^\n]*|/\*.*?\*/)*', re.S)
+_STR_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_VERBATIM_RE = re.compile(r'@"[^"]*(?:""[^"]*)*"')
+_NUM_RE = re.compile(r'-?\d+(?:\.\d+)?(?:e[+-]?\d+)?')
+_REF_RE = re.compile(r'(?:::)?[a-zA-Z_]\w*(?:\.[a-zA-Z_]\w*)*')
+_KEY_RE = re.compile(r'[a-zA-Z_]\w*')
+_STMT_RE = re.compile(r'\blocal\s+([a-zA-Z_]\w*)\s*=|((?:::)?[a-zA-Z_][\w.]*)\s*<-'
+                      r'|(?<![\w.:])((?:::)?[a-zA-Z_][\w.]*)\.(add|addCompiled)\s*\(')
+
+def parse_nut(text):
+    """Evaluates literals in a squirrel file: top level locals and slots, i.e. local pairs = [...]
+       and X <- {...}, and Rosetta.add(...) or .addCompiled(...) calls, also via a local alias,
+       i.e. local def = ::Rosetta, use .resolve() to get
+       their args. Literals are strings, numbers, bools, null, arrays and tables, anything else
+       is kept as NutFunction or NutExpr. Spans of values and args are kept to allow rewriting."""
+    parser = NutParser(text)
+    vars, spans, calls = {}, {}, []
+    pos = 0
+    while m := _STMT_RE.search(text, pos):
+        parser.pos = m.end()
+        if m.group(4):
+            if _is_rosetta(m.group(3), vars):
+                args, arg_spans = parser.args()
+                calls.append(NutCall(m.group(4), m.start(4), args, arg_spans))
+        else:
+            name = m.group(1) or m.group(2)
+            parser._skip()
+            start = parser.pos
+            vars[name] = parser.value()
+            spans[name] = (start, parser.pos)
+        pos = parser.pos
+    return NutFile(vars, spans, calls)
+
+def _is_rosetta(ref, vars):
+    if isinstance(alias := vars.get(ref), NutExpr):
+        ref = alias.source
+    return ref.rsplit(".", 1)[-1].removeprefix("::") == "Rosetta"
+
+class NutParser:
+    def __init__(self, text):
+        self.text, self.pos = text, 0
+
+    def value(self):
+        val = self._operand()
+        # Only string concatenation is supported, anything else is an expression
+        while True:
+            end = self.pos
+            if not self._peek('+'):
+                self.pos = end  # Leave trailing whitespace and comments out of value span
+                return val
+            start = self.pos
+            self.pos += 1
+            right = self._operand()
+            if isinstance(val, str) and isinstance(right, str):
+                val += right
+            else:
+                self.pos = start
+                return self._expr_rest(val)
+
+    def args(self):
+        args, spans = [], []
+        while not self._eat(')'):
+            start = self.pos
+            args.append(self.value())
+            spans.append((start, self.pos))
+            self._eat(',')
+        return args, spans
+
+    def _operand(self):
+        self._skip()
+        text, c = self.text, self.text[self.pos:self.pos + 1]
+        if c == '"':
+            return ast.literal_eval(self._match(_STR_RE))
+        elif text.startswith('@"', self.pos):
+            return self._match(_VERBATIM_RE)[2:-1].replace('""', '"')
+        elif c == '[':
+            self.pos += 1
+            items = []
+            while not self._eat(']'):
+                items.append(self.value())
+                self._eat(',')
+            return items
+        elif c == '{':
+            self.pos += 1
+            return self._table()
+        elif c.isdigit() or c == '-':
+            num = self._match(_NUM_RE)
+            return float(num) if '.' in num or 'e' in num else int(num)
+        elif text.startswith('function', self.pos) or text.startswith('@(', self.pos):
+            return self._function()
+        elif ref := _REF_RE.match(text, self.pos):
+            self.pos = ref.end()
+            if ref.group() in ('true', 'false', 'null'):
+                return {'true': True, 'false': False, 'null': None}[ref.group()]
+            return self._expr_rest(NutExpr(ref.group()))
+        self._error("Unexpected character")
+
+    def _table(self):
+        table = {}
+        while not self._eat('}'):
+            self._skip()
+            if self.text.startswith('function', self.pos):
+                start = self.pos
+                self.pos += len('function')
+                self._skip()
+                key = self._match(_KEY_RE)
+                self._balanced('(')
+                self._balanced('{')
+                table[key] = NutFunction(self.text[start:self.pos])
+            else:
+                if self._peek('"'):
+                    key = ast.literal_eval(self._match(_STR_RE))
+                    self._expect(':')
+                elif self._eat('['):
+                    key = self.value()
+                    self._expect(']')
+                    self._expect('=')
+                else:
+                    key = self._match(_KEY_RE)
+                    if not self._eat('='):
+                        self._expect('<-')
+                table[key] = self.value()
+            self._eat(',')
+        return table
+
+    def _function(self):
+        start = self.pos
+        if self.text.startswith('@', self.pos):
+            self.pos += 1
+            self._balanced('(')
+            self.value()
+        else:
+            self.pos += len('function')
+            self._skip()
+            if m := _KEY_RE.match(self.text, self.pos):
+                self.pos = m.end()
+            self._balanced('(')
+            self._balanced('{')
+        return NutFunction(self.text[start:self.pos])
+
+    def _expr_rest(self, val):
+        """Consumes the rest of a non-literal expression: calls, indexes and binary ops"""
+        start = self.pos
+        source = val.source if isinstance(val, (NutExpr, NutFunction)) else repr(val)
+        while True:
+            end = self.pos
+            self._skip()
+            c = self.text[self.pos:self.pos + 1]
+            if c in ('(', '['):
+                self._balanced(c)
+            elif c == '.' or c and c in '+-*/%' and not self.text.startswith('//', self.pos):
+                self.pos += 1
+                self._operand()
+            else:
+                self.pos = end
+                break
+        return NutExpr(source + self.text[start:self.pos]) if self.pos > start else val
+
+    def _balanced(self, open):
+        self._expect(open)
+        close = {'(': ')', '[': ']', '{': '}'}[open]
+        depth = 1
+        while depth:
+            self._skip()
+            if self.pos >= len(self.text):
+                self._error(f"Unbalanced {open}")
+            c = self.text[self.pos]
+            if c == '"':
+                self._match(_STR_RE)
+            elif self.text.startswith('@"', self.pos):
+                self._match(_VERBATIM_RE)
+            elif c == "'":
+                self.pos = self.text.index("'", self.pos + 2) + 1
+            else:
+                depth += (c == open) - (c == close)
+                self.pos += 1
+
+    def _skip(self):
+        self.pos = _SKIP_RE.match(self.text, self.pos).end()
+
+    def _peek(self, s):
+        self._skip()
+        return self.text.startswith(s, self.pos)
+
+    def _eat(self, s):
+        if self._peek(s):
+            self.pos += len(s)
+            return True
+        return False
+
+    def _expect(self, s):
+        if not self._eat(s):
+            self._error(f"Expected {s}")
+
+    def _match(self, regex):
+        m = regex.match(self.text, self.pos)
+        if not m:
+            self._error("Unexpected character")
+        self.pos = m.end()
+        return m.group()
+
+    def _error(self, message):
+        line = self.text.count('\n', 0, self.pos) + 1
+        raise NutSyntaxError(f"{message} at line {line}: {self.text[self.pos:self.pos + 20]!r}")
+
+
+if __name__ == "__main__":
+    main()
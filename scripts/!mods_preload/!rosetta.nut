@@ -7,6 +7,7 @@
 //    => ignore this for now
 // 4. Longest keyword or something? Require static start or end?
 //    => first non-tag non-stopword lowercased
+//    => rarest of those across all rules, see _buildRules()
 // 5. What if we have match at the start? Then the string might have different contentKey!!!
 //    => go thorugh all potential content keys in a string to translate
 // 6. What do we do with < and > in original strings?
@@ -41,25 +42,45 @@ Table.extend(def, {
         active = _lang;
         // TODO: return en Name and Tooltip before dropping cache
         perksCache = {}; // Empty cache
+        clearMemo();
+
+        if (_lang in pending) {
+            local queue = pending[_lang];
+            delete pending[_lang];
+            foreach (args in queue) {
+                if (args[2]) addCompiled(args[0], args[1]);
+                else add(args[0], args[1]);
+            }
+        }
     }
 
     maps = {}
+    // Pairs of languages not active, these are only validated and parsed once activated.
+    // Mods bundle several languages, while only one is used.
+    pending = {}
+    function _defer(_lang, _def, _pairs, _compiled) {
+        if (!(_lang in pending)) pending[_lang] <- [];
+        pending[_lang].push([_def, _pairs, _compiled]);
+    }
     function add(_def, _pairs) {
         local lang = _def.lang;
-        Log.log("Adding " + _pairs.len() + " " + lang + " pairs in " + _def.mod.id);
         if (!(lang in langs))
             throw "Please register your language with ::Rosetta.addLang(" + lang + ", ...) first";
+        if (lang != active) return _defer(lang, _def, _pairs, false);
+        Log.log("Adding " + _pairs.len() + " " + lang + " pairs in " + _def.mod.id);
 
-        if (!(lang in maps)) maps[lang] <- {strs = {}, ids = {}, rules = {}};
-        local strs = maps[lang].strs, ids = maps[lang].ids, rules = maps[lang].rules;
+        if (!(lang in maps)) maps[lang] <- _newMap();
+        clearMemo();
+        local amap = maps[lang], strs = amap.strs, ids = amap.ids;
         foreach (pair in _pairs) {
             if (!validatePair(lang, pair)) continue;
 
             local mode = Table.get(pair, "mode", "str");
             if (mode == "pattern" || "plural" in pair || "split" in pair) {
-                local key = _ruleKey(pair.en);
-                if (!(key in rules)) rules[key] <- [];
-                rules[key].push(makeRule(lang, pair));
+                local rule = makeRule(lang, pair);
+                rule.keys <- _ruleKeys(pair.en);
+                amap.ruleList.push(rule);
+                amap.dirty = true;
             } else {
                 if ("id" in pair) ids[pair.id] <- pair[lang];
                 if ("en" in pair) strs[pair.en] <- pair[lang];
@@ -68,13 +89,68 @@ Table.extend(def, {
 
         // Log stats
         if (Stats.enabled) {
-            local rulesNum = Array.sum(Table.values(rules).map(@(v) v.len()));
+            local rulesNum = amap.ruleList.len();
             Stats.log(ids.len() + " ids, " + strs.len() + " strings, " + rulesNum + " rules.");
-            if (rules.len() > 0) {
-                local ruleCounts = Table.mapValues(rules, @(k, v) v.len());
-                local limit = Array.nlargest(3, Table.values(ruleCounts)).top();
-                Stats.log("most used keys", ruleCounts, {filter = @(k, v) k == "" || v >= limit});
+        }
+    }
+    // Rules are put into buckets by keys lazily, since the choice of a key depends on all of them
+    function _newMap() {
+        return {strs = {}, ids = {}, rules = {}, ruleList = [], dirty = false};
+    }
+    // Adds pairs precompiled with rosetta.py --compile, these are already validated and parsed
+    function addCompiled(_def, _compiled) {
+        local lang = _def.lang;
+        if (!(lang in langs))
+            throw "Please register your language with ::Rosetta.addLang(" + lang + ", ...) first";
+        if (lang != active) return _defer(lang, _def, _compiled, true);
+        Log.log("Adding compiled " + lang + " pairs in " + _def.mod.id);
+
+        if (!(lang in maps)) maps[lang] <- _newMap();
+        clearMemo();
+        local amap = maps[lang];
+        Table.extend(amap.strs, _compiled.strs);
+        Table.extend(amap.ids, _compiled.ids);
+        if (_compiled.rules.len() > 0) {
+            amap.ruleList.extend(_compiled.rules);
+            amap.dirty = true;
+        }
+    }
+    // Each rule goes into the bucket of its rarest word, so that common ones, like "damage",
+    // won't pile up dozens of rules to try one by one. translate() looks into all buckets
+    // of words in a string, so any literal word of a pattern will do.
+    function _buildRules(_amap) {
+        local freqs = {};
+        foreach (rule in _amap.ruleList) {
+            foreach (key in rule.keys) {
+                if (key in freqs) freqs[key]++;
+                else freqs[key] <- 1;
+            }
+        }
+        local rules = {};
+        foreach (rule in _amap.ruleList) {
+            local best = rule.keys[0];
+            foreach (key in rule.keys) if (freqs[key] < freqs[best]) best = key;
+            if (best in rules) rules[best].push(rule);
+            else rules[best] <- [rule];
+        }
+        _amap.rules = rules;
+        _amap.dirty = false;
+        // Hits were counted for the old buckets, start over for the new ones
+        ruleHits = {};
+        reorderCount = 0;
+
+        if (Stats.enabled && rules.len() > 0) {
+            local sizes = {};
+            foreach (key, keyRules in rules) {
+                local n = keyRules.len();
+                local bin = n <= 2 ? n.tostring() : n <= 5 ? "3-5" : n <= 10 ? "6-10" : "11+";
+                if (bin in sizes) sizes[bin]++;
+                else sizes[bin] <- 1;
             }
+            Stats.log("rule buckets by size", sizes);
+            local ruleCounts = Table.mapValues(rules, @(k, v) v.len());
+            local limit = Array.nlargest(3, Table.values(ruleCounts)).top();
+            Stats.log("most used keys", ruleCounts, {filter = @(k, v) k == "" || v >= limit});
         }
     }
     function validatePair(_lang, _pair) {
@@ -129,12 +205,19 @@ Table.extend(def, {
     function _stripTags(_str) {
         return Re.replace(_str, tagsRe, " ");
     }
-    function _ruleKey(_pat) {
+    // Literal words of a pattern, any of these could be used as its key, see _buildRules()
+    function _ruleKeys(_pat) {
         local str = Re.replace(_pat, patternKeyRe, function (_prefix, _sub, _suffix) {
             return _sub == "tag" || Str.endswith(_sub, "_tag")
                 ? (_prefix || "") + " " + (_suffix || "") : "";
         })
-        return resume _iterKeys(str);
+        local keys = [], seen = {};
+        foreach (w in _iterKeys(str)) {
+            if (w in seen || w == "" && keys.len() > 0) continue;
+            seen[w] <- true;
+            keys.push(w);
+        }
+        return keys;
     }
     // TODO: return longer words first
     function _iterKeys(_str) {
@@ -171,8 +254,26 @@ Table.extend(def, {
                 rule[key] <- parseReplacement(val);
         }
         validateRule(_lang, rule);
+        _addPrefilter(rule);
         return rule;
     }
+    // Literal parts a string should contain to match, checked before matchParts(), which slices.
+    // The longest of the middle ones is checked, prefix and suffix need to be at their places.
+    function _addPrefilter(_rule) {
+        local minLen = 0, prefix = "", suffix = "", literal = "";
+        local last = _rule.parts.len() - 1;
+        foreach (i, p in _rule.parts) {
+            if (typeof p != "string") continue;
+            minLen += p.len();
+            if (i == 0) prefix = p;
+            else if (i == last) suffix = p;
+            else if (p.len() > literal.len()) literal = p;
+        }
+        _rule.minLen <- minLen;
+        _rule.prefix <- prefix;
+        _rule.suffix <- suffix;
+        _rule.literal <- literal;
+    }
     function parsePattern(_pat) {
         return Re.all(_pat, patternRe).map(
             @(p) p[0] && p[0] != "" ? p[0] : {name = p[1], sub = p[2]})
@@ -234,8 +335,83 @@ Table.extend(def, {
         return Re.all(Re.replace(full, @"\d+", "1"), asciiRe)
     }
 
+    // Rule results by string. Ids are looked up before rules, so these don't depend on them.
+    // Two generations: when memo fills up it becomes memoOld, strings still in use get back.
+    memoSize = 5000
+    memo = {}
+    memoOld = {}
+    // Same for strings nothing matched, these are mostly names and numbers, so kept apart
+    // not to push out the memo
+    missedSize = 5000
+    missed = {}
+    missedOld = {}
+    // Changes with language and translations, values cached elsewhere check it, see cachedGetter()
+    generation = 0
+    function clearMemo() {
+        generation++;
+        memo = {};
+        memoOld = {};
+        missed = {};
+        missedOld = {};
+        tooltipCache = {};
+        tooltipCacheOld = {};
+        ruleHits = {};
+    }
+    function _memoize(_str, _value) {
+        if (memo.len() >= memoSize) {
+            memoOld = memo;
+            memo = {};
+        }
+        memo[_str] <- _value;
+    }
+    function _rememberMiss(_str) {
+        if (missed.len() >= missedSize) {
+            missedOld = missed;
+            missed = {};
+        }
+        missed[_str] <- true;
+    }
+
+    // Adaptive mode, opt in with ::Rosetta.adaptive = true. Rules in each bucket are periodically
+    // reordered by hits, most hit first. Only rules that can't match the same string are swapped,
+    // so for any string the first matching rule stays the same.
+    adaptive = false
+    reorderEvery = 1000
+    reorderCount = 0
+    ruleHits = {}
+    function _reorderRules(_amap) {
+        foreach (key, keyRules in _amap.rules) {
+            // Sort a copy, the original might be iterated by a translate() up the stack
+            local sorted = clone keyRules;
+            for (local i = 1; i < sorted.len(); i++) {
+                local rule = sorted[i], hits = Table.get(ruleHits, rule, 0), j = i;
+                while (j > 0 && Table.get(ruleHits, sorted[j - 1], 0) < hits
+                        && _disjoint(sorted[j - 1], rule)) {
+                    sorted[j] = sorted[j - 1];
+                    j--;
+                }
+                sorted[j] = rule;
+            }
+            _amap.rules[key] = sorted;
+        }
+    }
+    // Whether two rules can't match the same string, judging by their fixed prefixes and suffixes
+    function _disjoint(_a, _b) {
+        local ap = _a.prefix, bp = _b.prefix, as = _a.suffix, bs = _b.suffix;
+        if (ap != "" && bp != "") {
+            local n = ap.len() < bp.len() ? ap.len() : bp.len();
+            if (ap.slice(0, n) != bp.slice(0, n)) return true;
+        }
+        if (as != "" && bs != "") {
+            local n = as.len() < bs.len() ? as.len() : bs.len();
+            if (as.slice(as.len() - n) != bs.slice(bs.len() - n)) return true;
+        }
+        return false;
+    }
+
     keysSeen = {}
-    stats = {hits = 0, misses = 0, rule_hits = 0, rule_uses = 0}
+    stats = {hits = 0, misses = 0, rule_hits = 0, rule_uses = 0, memo_hits = 0, memo_misses = 0,
+             misses_saved = 0}
     ruleUseKeys = {}
     function tap(_str, _id, _value, _rule = false) {
         if (Stats.enabled) {
@@ -269,6 +445,28 @@ Table.extend(def, {
         else if (_str in amap.strs) ret = amap.strs[_str];
         if (ret && ret != "") return tap(_str, _id, ret);
 
+        // Split parts are translated skipping the split rule, so these go around memo
+        if (_skip_rule == null) {
+            // Known misses skip tap() too, they were logged the first time
+            if (_str in missed || _str in missedOld) {
+                if (!(_str in missed)) _rememberMiss(_str);
+                if (Stats.enabled) {
+                    stats.misses++;
+                    stats.misses_saved++;
+                }
+                return _str;
+            }
+
+            local memoized = null;
+            if (_str in memo) memoized = memo[_str];
+            else if (_str in memoOld) {
+                memoized = memoOld[_str];
+                _memoize(_str, memoized);
+            }
+            if (Stats.enabled) stats[memoized != null ? "memo_hits" : "memo_misses"]++;
+            if (memoized != null) return tap(_str, _id, memoized, true);
+        }
+
         if (Stats.enabled) {
             if (stats.rule_uses > 0 && stats.rule_uses % 100 == 0) {
                 Stats.log("stats", stats);
@@ -276,16 +474,35 @@ Table.extend(def, {
                     local limit = Array.nlargest(3, Table.values(ruleUseKeys)).top();
                     Stats.log("most used keys", ruleUseKeys, {filter = @(k, v) k == "" || v >= limit});
                 }
+                if (ruleHits.len() > 0) {
+                    local hits = {};
+                    foreach (rule, n in ruleHits) hits[rule.en] <- n;
+                    local limit = Array.nlargest(3, Table.values(hits)).top();
+                    Stats.log("most hit rules", hits, {filter = @(k, v) v >= limit});
+                }
             }
             stats.rule_uses++;
         }
         // Look for pattern
-        // TODO: think of rules priority, now it's mixed whichever gets the first key,
-        //       then added order
+        // Rules are tried whichever gets the first key, then added order,
+        // unless reordered by hits in adaptive mode
+        if (amap.dirty) _buildRules(amap);
+        if (adaptive && ++reorderCount >= reorderEvery) {
+            reorderCount = 0;
+            _reorderRules(amap);
+        }
+        local sn = _str.len();
         foreach (key in _iterKeys(_str)) {
             foreach (rule in Table.get(amap.rules, key, [])) {
                 if (rule == _skip_rule) continue; // Protect against split rule stack overflow
                                                   // TODO: nicer way to do this?
+                // Prefilter, see _addPrefilter()
+                if (sn < rule.minLen) continue;
+                if (rule.prefix != "" && _str.find(rule.prefix) != 0) continue;
+                if (rule.suffix != "" && _str.find(rule.suffix, sn - rule.suffix.len()) == null)
+                    continue;
+                if (rule.literal != "" && _str.find(rule.literal, rule.prefix.len()) == null)
+                    continue;
                 if (Stats.enabled) {
                     if (key in ruleUseKeys) ruleUseKeys[key]++; else ruleUseKeys[key] <- 1;
                 }
@@ -299,9 +516,12 @@ Table.extend(def, {
                     Log.log("partial fail for " + _str, rule);
                     continue;
                 }
+                if (_skip_rule == null) _memoize(_str, ret);
+                if (adaptive || Stats.enabled) ruleHits[rule] <- Table.get(ruleHits, rule, 0) + 1;
                 return tap(_str, _id, ret, true)
             }
         }
+        if (_skip_rule == null) _rememberMiss(_str);
         return tap(_str, _id, null, true);
     }
     function useRule(_rule, _str, _matches) {
@@ -335,58 +555,78 @@ Table.extend(def, {
     // Using single Re.replace() would be far less verbose, unforturnately Squirrel's regex engine
     // doesn't backtrack across :str + an anchor. Regex simply does not match.
     // So we walk here manually for :str. As a bonus this is alse twice as fast.
+    // The walk goes by offsets, captures are only sliced on success.
+    matchSpans = []
     function matchParts(_str, _parts) {
-        local pos = 0, matches = {};
-        local sn = _str.len();
-        for (local i = 0; i < _parts.len(); i++) {
+        local n = _parts.len() * 2;
+        if (matchSpans.len() < n) matchSpans.resize(n);
+        if (!_matchFrom(_str, _parts, 0, 0)) return null;
+
+        local matches = {};
+        foreach (i, p in _parts) {
+            if (typeof p == "table")
+                matches[p.name] <- _str.slice(matchSpans[i * 2], matchSpans[i * 2 + 1]);
+        }
+        return matches;
+    }
+    // Matches _parts from _i on against _str from _pos, stores capture offsets into matchSpans
+    function _matchFrom(_str, _parts, _i, _pos) {
+        local spans = matchSpans, sn = _str.len(), pos = _pos;
+        for (local i = _i; i < _parts.len(); i++) {
             local p = _parts[i];
             if (typeof p == "string") {
                 local pn = p.len();
-                if (pos + pn > sn || _str.slice(pos, pos + pn) != p) return null;
+                if (pos + pn > sn) return false;
+                for (local j = 0; j < pn; j++) {
+                    if (_str[pos + j] != p[j]) return false;
+                }
                 pos += pn;
             } else if (p.sub != "str") {
-                local re = subRes[p.sub];
-                local m = re.search(_str, pos);
-                if (m == null || m.begin != pos) return null;
-                matches[p.name] <- _str.slice(m.begin, m.end);
+                local m = subRes[p.sub].search(_str, pos);
+                if (m == null || m.begin != pos) return false;
+                spans[i * 2] = pos;
+                spans[i * 2 + 1] = m.end;
                 pos = m.end;
             } else {
                 if (i == _parts.len() - 1) {
-                    matches[p.name] <- _str.slice(pos);
-                    return matches;
+                    spans[i * 2] = pos;
+                    spans[i * 2 + 1] = sn;
+                    return true;
                 }
-                local next = _parts[i + 1], re;
+                local next = _parts[i + 1], re = null;
                 if (typeof next == "table") {
                     assert(next.sub != "str", "Should be prevented by rule validation")
                     re = subRes[next.sub];
                 }
 
-                local np = pos, m;
+                local np = pos, end;
                 while (true) {
                     // We look matches from left to right, this makes <...:str> non-greedy
-                    if (typeof next == "string") {
+                    if (re == null) {
                         np = _str.find(next, np);
-                        if (np == null) return null;
-                        m = {begin = np, end = np + next.len()}
+                        if (np == null) return false;
+                        end = np + next.len();
                     } else {
-                        m = re.search(_str, np);
-                        if (!m) return null;
+                        local m = re.search(_str, np);
+                        if (!m) return false;
                         np = m.begin;
+                        end = m.end;
                     }
 
-                    local tailMatches = matchParts(_str.slice(m.end), _parts.slice(i + 2));
-                    if (tailMatches) {
-                        matches[p.name] <- _str.slice(pos, np);
-                        if (typeof next != "string")
-                            matches[next.name] <- _str.slice(m.begin, m.end);
-                        return Table.extend(matches, tailMatches)
+                    if (_matchFrom(_str, _parts, i + 2, end)) {
+                        spans[i * 2] = pos;
+                        spans[i * 2 + 1] = np;
+                        if (re != null) {
+                            spans[i * 2 + 2] = np;
+                            spans[i * 2 + 3] = end;
+                        }
+                        return true;
                     }
                     np++;
                 }
-                return null;
             }
         }
-        return pos == sn ? matches : null;
+        return pos == sn;
     }
     function plural(_s) {
         local n;
@@ -401,11 +641,76 @@ Table.extend(def, {
         return langs[active].plural.choose(n);
     }
 
+    // Getter hooks for names and descriptions, these are called a lot each frame. Each object
+    // keeps translations in its m by the original value, so it's only translated again when
+    // the value or the generation changes. Values are per getter, since nested hooked getters,
+    // i.e. of a class and its base, see different original values.
+    getterCacheSize = 8
+    function cachedGetter(_getter, _translate) {
+        local self = this;
+        return @(__original) function () {
+            local str = __original();
+            if (typeof str != "string") return str;
+
+            if (!("RosettaCache" in m) || m.RosettaCache.generation != self.generation)
+                m.RosettaCache <- {generation = self.generation};
+            local cache = m.RosettaCache;
+            if (!(_getter in cache)) cache[_getter] <- {};
+            local values = cache[_getter];
+            if (str in values) return values[str];
+
+            if (values.len() >= self.getterCacheSize) values.clear();
+            local ret = _translate.call(this, str);
+            values[str] <- ret;
+            return ret;
+        }
+    }
+    function simpleGetter(_getter) {
+        local self = this;
+        return cachedGetter(_getter, @(_str) self.translate(_str));
+    }
+    // Also looks up by id, which is built from the script of an object and a field
+    function idGetter(_getter, _field) {
+        local self = this;
+        return cachedGetter(_getter, function (_str) {
+            local script = ::IO.scriptFilenameByHash(this.ClassNameHash);
+            return self.translate(_str, script + "." + _field);
+        });
+    }
+
+    function translateMany(_strs) {
+        local ret = array(_strs.len());
+        foreach (i, s in _strs) ret[i] = translate(s);
+        return ret;
+    }
+    // Tooltips are queried again on each hover, so translated texts are kept by all texts joined.
+    // Two generations like memo, cleared with it.
+    tooltipCacheSize = 500
+    tooltipCache = {}
+    tooltipCacheOld = {}
     function translateTooltip(_tooltip) {
         if (_tooltip == null) return null;
-        local self = this;
-        return _tooltip.map(
-            @(item) "text" in item ? Table.extend(item, {text = self.translate(item.text)}) : item);
+        local items = [], key = "";
+        foreach (item in _tooltip) {
+            if (!("text" in item) || typeof item.text != "string") continue;
+            items.push(item);
+            key += item.text + "\x1f";
+        }
+        if (items.len() == 0) return _tooltip;
+
+        local texts;
+        if (key in tooltipCache) texts = tooltipCache[key];
+        else {
+            texts = key in tooltipCacheOld ? tooltipCacheOld[key]
+                                           : translateMany(items.map(@(item) item.text));
+            if (tooltipCache.len() >= tooltipCacheSize) {
+                tooltipCacheOld = tooltipCache;
+                tooltipCache = {};
+            }
+            tooltipCache[key] <- texts;
+        }
+        foreach (i, item in items) item.text = texts[i];
+        return _tooltip;
     }
     perksCache = {}
     function translatePerk(_perk) {
@@ -421,6 +726,75 @@ Table.extend(def, {
     function translatePerkTree(_perks) {
         return _perks.map(@(row) row.map(@(p) ::Rosetta.translatePerk(p)));
     }
+
+    // Profiling, opt in with ::Rosetta.profiling = true before hooks are set, i.e. in preload.
+    // Hooks and translate are only wrapped then, so there is no overhead without it.
+    // Call ::Rosetta.dumpProfile() to see the summary, it's also logged every profileInterval.
+    profiling = false
+    profileInterval = 60.0 // seconds
+    profileSlowest = 5
+    profile = {}
+    profileDumped = 0.0
+    function profiled(_name, _func) {
+        if (!(_name in profile))
+            profile[_name] <- {calls = 0, time = 0.0, depth = 0, slowest = []};
+        local self = this, rec = profile[_name];
+        return function (...) {
+            vargv.insert(0, this);
+            // Nested calls are already counted by the outer one, i.e. translate() for :t
+            // or getName() of a subclass calling base one, both hooked
+            if (rec.depth > 0) return _func.acall(vargv);
+
+            rec.depth++;
+            local start = ::Time.getExactTime(), ret;
+            try {
+                ret = _func.acall(vargv);
+            } catch (err) {
+                rec.depth--;
+                throw err;
+            }
+            local now = ::Time.getExactTime();
+            rec.depth--;
+            self._profileCall(rec, now - start, vargv, ret);
+            if (now - self.profileDumped >= self.profileInterval) {
+                if (self.profileDumped > 0) self.dumpProfile();
+                self.profileDumped = now;
+            }
+            return ret;
+        }
+    }
+    function _profileCall(_rec, _time, _args, _ret) {
+        _rec.calls++;
+        _rec.time += _time;
+
+        local slowest = _rec.slowest;
+        if (slowest.len() >= profileSlowest && _time <= slowest.top()[0]) return;
+        // Show what was translated: the first string argument or a string result
+        local str = typeof _ret == "string" ? _ret : "";
+        for (local i = _args.len() - 1; i > 0; i--) {
+            if (typeof _args[i] == "string") str = _args[i];
+        }
+        local i = slowest.len();
+        while (i > 0 && slowest[i - 1][0] < _time) i--;
+        slowest.insert(i, [_time, str]);
+        if (slowest.len() > profileSlowest) slowest.pop();
+    }
+    function dumpProfile() {
+        local names = [];
+        foreach (name, _ in profile) names.push(name);
+        names.sort(@(a, b) profile[b].time <=> profile[a].time);
+        Log.log("profile, " + names.len() + " hooks by total time:");
+        foreach (name in names) {
+            local rec = profile[name];
+            if (rec.calls == 0) continue;
+            Log.log(format("%10.2fms %8d calls %8.1fus avg  %s",
+                rec.time * 1000, rec.calls, rec.time * 1000000 / rec.calls, name));
+            foreach (s in rec.slowest) {
+                local str = s[1].len() > 80 ? s[1].slice(0, 80) + "..." : s[1];
+                Log.log(format("%22.1fus  %s", s[0] * 1000000, Re.replace(str, @"\n", @"\n")));
+            }
+        }
+    }
 })
 def._ <- def.translate.bindenv(def); // Make it usable in map()
 
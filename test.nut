@@ -38,6 +38,11 @@ assertEq(def.parsePattern("1 ... <range:int>"),
         ["1 ... ", {name = "range", sub = "int"}]);
 
 
+// Prefilter
+local rule = def.makeRule("ru", {mode = "pattern", en = "Has <x:int> of <y:int> tiles", ru = "<x> <y>"});
+assertEq([rule.minLen, rule.prefix, rule.suffix, rule.literal], [14, "Has ", " tiles", " of "]);
+
+
 // ...
 local s = "[imgtooltip=mod_msu.Perk+perk_brawny]gfx/ui/perks/perk_40.png[/imgtooltip]"
 assertEq(!!def._isInteresting(s), false);
@@ -51,149 +56,12 @@ assertEq(def._clean(bbtag), "")
 
 ::Rosetta.stats.rule_uses = 100; // check logging stats
 
-// Translate via pattern
-setup({
-    mode = "pattern"
-    en = "Has a range of <range:int> tiles"
-    ru = "Дальность <range> клеток"
-})
-assertTr("Has a range of 5 tiles", "Дальность 5 клеток");
-
-setup({
-    mode = "pattern"
-    en = "Has a range of <open:tag><range:int><close:tag> tiles"
-    ru = "Дальность <open><range><close> клеток"
-})
-assertTr("Has a range of [b]5[/b] tiles", "Дальность [b]5[/b] клеток");
-
-setup({
-    mode = "pattern"
-    en = "Has a range of <range:int_tag> tiles"
-    ru = "Дальность <range> клеток"
-})
-assertTr("Has a range of [b]5[/b] tiles", "Дальность [b]5[/b] клеток");
-assertTr("it Has a range of [b]5[/b] tiles", "it Has a range of [b]5[/b] tiles"); // prefix
-assertTr("Has a range of [b]5[/b] tiles.", "Has a range of [b]5[/b] tiles."); // suffix
-
-// plurals
-setup({
-    plural = "range"
-    en = "Has a range of <range:int> tiles"
-    n1 = "Дальность - <range> клетка"
-    n2 = "Дальность - <range> клетки"
-    n5 = "Дальность - <range> клеток"
-})
-assertTr("Has a range of 1 tiles", "Дальность - 1 клетка");
-assertTr("Has a range of 31 tiles", "Дальность - 31 клетка");
-assertTr("Has a range of 23 tiles", "Дальность - 23 клетки");
-assertTr("Has a range of 5 tiles", "Дальность - 5 клеток");
-assertTr("Has a range of 14 tiles", "Дальность - 14 клеток");
-
-setup({
-    plural = "range"
-    en = "Has a range of <range:int_tag> tiles"
-    n1 = "Дальность - <range> клетка"
-    n2 = "Дальность - <range> клетки"
-    n5 = "Дальность - <range> клеток"
-})
-assertTr("Has a range of [b]4[/b] tiles", "Дальность - [b]4[/b] клетки");
-
-// Reverse labels and no proper contenKey
-setup({
-    mode = "pattern"
-    en = "<x:int> and <y:int>"
-    ru = "<y> и <x>"
-})
-assertTr("11 and 22", "22 и 11");
-
-// This works using "" rule key
-setup({
-    mode = "pattern"
-    en = "Some<x:int>"
-    ru = "Типа<x>"
-})
-assertTr("Some2", "Типа2");
-
-// Label match as a potential contentKey
-setup({
-    mode = "pattern"
-    en = "<name:word> says hello"
-    ru = "<name> передаёт привет"
-})
-assertTr("Yarg says hello", "Yarg передаёт привет");
-assertTr("Йарг says hello", "Йарг передаёт привет"); // Check matching non-english words
-
-
-setup({
-    mode = "pattern"
-    en = "with <others:str> you only"
-    ru = "с <others> вы только"
-})
-assertTr("with Nimble you only", "с Nimble вы только");
-// Multi-word :str -- exposed Squirrel's regexp backtracking bug, motivated matchParts().
-assertTr("with Nimble and Battle Forged you only", "с Nimble and Battle Forged вы только");
-
-setup({
-    mode = "pattern"
-    en = "with <item:str><num:int> item"
-    ru = "с предметом <item><num>"
-})
-assertTr("with Sword+1 item", "с предметом Sword+1");
-assertTr("with Battle Axe+1 item", "с предметом Battle Axe+1");
-
-// :line -- like :str but bounded by \n; eats the trailing \n (or end of string)
-assertEq(def.parsePattern("Spent <x:line>"),
-        ["Spent ", {name = "x", sub = "line"}]);
-
-setup({
-    mode = "pattern"
-    en = "Spent <x:line>"
-    ru = "Потратил <x>"
-})
-assertTr("Spent foo", "Потратил foo");
-// The fix: :line does not cross \n -- with :str the rule would greedy-eat past
-// the newline and translate "Spent foo\nrest" as "Потратил foo\nrest".
-assertTr("Spent foo\nrest", "Spent foo\nrest"); // didn't match, returned as-is
-
-// :line eats the trailing \n; the literal that follows starts AFTER it.
-setup({
-    mode = "pattern"
-    en = "<x:line>then <y:str>"
-    ru = "<x>далее <y>"
-})
-assertTr("first\nthen rest", "first\nдалее rest");
-
-// Limitation: :line is greedy and the engine doesn't backtrack -- same family
-// of issues as :str via single regex. Don't place :line before a non-\n anchor;
-// it will eat it whole and the rule won't match.
-setup({
-    mode = "pattern"
-    en = "<x:line> tail"
-    ru = "<x> хвост"
-})
-assertTr("abc tail", "abc tail"); // didn't match
-
-
-setup({
-    mode = "pattern"
-    en = "Use <open:tag><ap:int> AP<close:tag> and <fat:str_tag> less fatigue."
-    ru = "Тратит только <open><ap> ОД<close> и на <fat> меньше выносливости."
-})
-assertTr(
-    "Use [color=#135213]4 AP[/color] and [color=#135213]25%[/color] less fatigue.",
-    "Тратит только [color=#135213]4 ОД[/color] и на [color=#135213]25%[/color] меньше выносливости."
-)
-
-
-setup({
-    mode = "pattern"
-    en = "this perk has a <chance:val_tag> chance"
-    ru = "По достижении 5 уровня есть <chance> шанс"
-})
-assertTr(
-    "this perk has a [color=#135213]70%[/color] chance",
-    "По достижении 5 уровня есть [color=#135213]70%[/color] шанс"
-)
+// Translation cases shared with test_runtime.py
+dofile("test_cases.nut", true);
+foreach (c in ::RosettaTestCases) {
+    setup(c.pairs);
+    foreach (tc in c.cases) assertTr(tc[0], tc[1]);
+}
 
 
 // Bad rules
@@ -231,195 +99,349 @@ try {
 assert(threw);
 
 
-// Double translation
+::Rosetta.stats.rule_uses = 200; // check logging stats
+
 setup([
     {
-        plural = "uses"
-        en = "Used nine lives <uses:int> times<end:str>"
-        n1 = "Использовал 'Девять жизней' <uses> раз<end:t>"
-        n2 = "Использовал 'Девять жизней' <uses> раза<end:t>"
-        n5 = "Использовал 'Девять жизней' <uses> раз<end:t>"
+        // local text = "Was " + Str.join(", ", desc);
+        mode = "pattern"
+        en = "Was <middle:str> times"
+        function use(_str, _m) {
+            return "Был " + ::Rosetta.useSplit(this, ", ", _m.middle + " times")
+        }
     }
     {
-        mode = "pattern"
-        en = "Used nine lives once<end:str>"
-        ru = "Однажды использовал 'Девять жизней'<end:t>"
+        // .map(@(n) format("%s %d times", n, effects[n]));
+        plural = "n"
+        en = "<effect:str> <n:int> times"
+        n1 = "<effect:t> <n> раз"
+        n2 = "<effect:t> <n> раза"
+        n5 = "<effect:t> <n> раз"
     }
     {
-        en = ", died every time"
-        ru = ", помирал каждый раз"
+        en = "charmed"
+        ru = "зачарован"
     }
     {
-        en = ", died anyway"
-        ru = ", всё равно подох"
+        en = "swallowed"
+        ru = "проглочен"
     }
     {
-        plural = "saves"
-        en = ", survived <saves:int> times"
-        n1 = ", выжил <saves> раз"
-        n2 = ", выжил <saves> раза"
-        n5 = ", выжил <saves> раз"
+        en = "netted"
+        ru = "спутан"
     }
     {
-        en = ", survived once"
-        ru = ", выжил разок"
+        en = "stunned"
+        ru = "оглушён"
     }
 ])
-assertTr(
-    "Used nine lives 2 times, survived once",
-    "Использовал 'Девять жизней' 2 раза, выжил разок"
-)
-assertTr(
-    "Used nine lives 7 times, died every time",
-    "Использовал 'Девять жизней' 7 раз, помирал каждый раз"
-)
-assertTr(
-    "Used nine lives 7 times, survived 3 times",
-    "Использовал 'Девять жизней' 7 раз, выжил 3 раза"
-)
-assertTr(
-    "Used nine lives once, died anyway",
-    "Однажды использовал 'Девять жизней', всё равно подох"
-)
-
-// Non-obvious rule keys
-setup({
-    mode = "pattern"
-    en = "<open:tag>is not perfect<close:tag>, i.e. "
-    ru = "<open>не идеально<close>, т.е. "
-})
-assertTr(
-    "[b]is not perfect[/b], i.e. ",
-    "[b]не идеально[/b], т.е. "
-)
+assertTr("Was stunned 2 times, swallowed 5 times", "Был оглушён 2 раза, проглочен 5 раз")
 
-setup({
-    mode = "pattern"
-    en = "<num:int> day<s:str>"
-    // en = "<num:int> day<|s>"
-    ru = "<num> дней"
-})
-assertTr("1 day", "1 дней")
-assertTr("5 days", "5 дней")
 
+// setup({
+//     mode = "pattern"
+//     en = "Level <lvl:int>, Health <hp:val>%" // val slurps %
+//     ru = "Уровень <lvl>, Здоровье <hp>%"
+// })
+// assertTr("Level 3, Health 100%", "Уровень 3, Здоровье 100%")
+
+
+// matchParts() against the old implementation, which sliced strings on each step
+function matchPartsSliced(_str, _parts) {
+    local pos = 0, matches = {};
+    local sn = _str.len();
+    for (local i = 0; i < _parts.len(); i++) {
+        local p = _parts[i];
+        if (typeof p == "string") {
+            local pn = p.len();
+            if (pos + pn > sn || _str.slice(pos, pos + pn) != p) return null;
+            pos += pn;
+        } else if (p.sub != "str") {
+            local re = def.subRes[p.sub];
+            local m = re.search(_str, pos);
+            if (m == null || m.begin != pos) return null;
+            matches[p.name] <- _str.slice(m.begin, m.end);
+            pos = m.end;
+        } else {
+            if (i == _parts.len() - 1) {
+                matches[p.name] <- _str.slice(pos);
+                return matches;
+            }
+            local next = _parts[i + 1], re;
+            if (typeof next == "table") {
+                assert(next.sub != "str", "Should be prevented by rule validation")
+                re = def.subRes[next.sub];
+            }
+
+            local np = pos, m;
+            while (true) {
+                // We look matches from left to right, this makes <...:str> non-greedy
+                if (typeof next == "string") {
+                    np = _str.find(next, np);
+                    if (np == null) return null;
+                    m = {begin = np, end = np + next.len()}
+                } else {
+                    m = re.search(_str, np);
+                    if (!m) return null;
+                    np = m.begin;
+                }
+
+                local tailMatches = matchPartsSliced(_str.slice(m.end), _parts.slice(i + 2));
+                if (tailMatches) {
+                    matches[p.name] <- _str.slice(pos, np);
+                    if (typeof next != "string")
+                        matches[next.name] <- _str.slice(m.begin, m.end);
+                    return ::std.Table.extend(matches, tailMatches)
+                }
+                np++;
+            }
+            return null;
+        }
+    }
+    return pos == sn ? matches : null;
+}
+
+local bbLong = "";
+foreach (i, stat in ["Melee Skill", "Ranged Skill", "Resolve", "Melee Defense", "Ranged Defense", "Initiative"])
+    bbLong += "[color=#135213]+" + (i + 3) + "[/color] " + stat + ", ";
+local benchCases = [
+    [bbLong + "and [color=#8f1e1e]-10%[/color] Max Fatigue", "<gains:str> and <fat:val_tag> Max Fatigue"]
+    [bbLong + "for [b]3[/b] turns", "<gains:str>, for <turns:int_tag> turns"]
+    [bbLong + "that's all", "<a:str> Resolve, <b:str> Initiative, <c:str>"]
+    [bbLong + "that's all", "<a:str> Resolve, <b:str> never <c:str>"]
+].map(@(c) [c[0], def.parsePattern(c[1])]);
+foreach (c in benchCases) assertEq(def.matchParts(c[0], c[1]), matchPartsSliced(c[0], c[1]));
+
+local function bench(_match) {
+    local start = clock();
+    for (local n = 0; n < 500; n++) {
+        foreach (c in benchCases) _match(c[0], c[1]);
+    }
+    return clock() - start;
+}
+print(format("matchParts: offsets %.3fs, slices %.3fs\n",
+    bench(@(s, p) def.matchParts(s, p)), bench(@(s, p) matchPartsSliced(s, p))));
+
+
+// Memo
 setup({
-    plural = "days"
-    en = "Light Wounds (<days:int> day<s:str>)"
-    n1 = "Лёгкие раны (<days> день)"
-    n2 = "Лёгкие раны (<days> дня)"
-    n5 = "Лёгкие раны (<days> дней)"
+    mode = "pattern"
+    en = "Has a range of <range:int> tiles"
+    ru = "Дальность <range> клеток"
 })
-assertTr("Light Wounds (1 day)", "Лёгкие раны (1 день)")
-assertTr("Light Wounds (2 days)", "Лёгкие раны (2 дня)")
+assertTr("Has a range of 5 tiles", "Дальность 5 клеток");
+assertEq(def.memo, {["Has a range of 5 tiles"] = "Дальность 5 клеток"});
+def.maps.ru.rules = {}; // Memo only
+assertTr("Has a range of 5 tiles", "Дальность 5 клеток");
+def.activate("ru");
+assertTr("Has a range of 5 tiles", "Has a range of 5 tiles");
 
 setup({
     mode = "pattern"
-    en = "<num:int> day<s:str><img:tag>"
-    ru = "<num> дней<img>"
+    en = "Has a range of <range:int> tiles"
+    ru = "Дальность <range> клеток"
 })
-assertTr("1 day[img]", "1 дней[img]")
-assertTr("5 days[img=123]", "5 дней[img=123]")
-
-
-::Rosetta.stats.rule_uses = 200; // check logging stats
-
+local memoSize = def.memoSize;
+def.memoSize = 2;
+foreach (n in [1 2 3]) def.translate("Has a range of " + n + " tiles");
+assertEq(def.memo.len(), 1);
+assertEq(def.memoOld.len(), 2);
+def.translate("Has a range of 1 tiles"); // Gets back from old generation
+assert("Has a range of 1 tiles" in def.memo);
+def.memoSize = memoSize;
+
+// Rules go into buckets by their rarest words
 setup([
     {
         mode = "pattern"
-        en = "<title:str> (Failed)"
-        ru = "<title:t> (Провал)"
+        en = "Damage to <x:str> armor"
+        ru = "Урон <x> броне"
     }
     {
-        en = "Something"
-        ru = "Что-то"
+        mode = "pattern"
+        en = "Damage dealt <x:int>"
+        ru = "Нанесено урона <x>"
     }
 ])
-assertTr("Something (Failed)", "Что-то (Провал)")
-
-// Don't allow partial
-setup({
-    mode = "pattern"
-    en = "<title:str> (Failed)"
-    ru = "<title:t> (Провал)"
-})
-assertTr("Something (Failed)", "Something (Failed)")
-
-
+assertEq(def._ruleKeys("Damage to <x:str> armor"), ["damage", "armor"]);
+assertEq(def._ruleKeys("Some<x:int>"), [""]);
+assertTr("Damage dealt 5", "Нанесено урона 5");
+assertTr("Damage to Bob armor", "Урон Bob броне");
+assertEq(def.maps.ru.rules.len(), 2);
+assert("armor" in def.maps.ru.rules && "dealt" in def.maps.ru.rules);
+
+// Adaptive rule order: only swaps rules, which can't match the same strings
 setup([
-    {
-        // mode = "pattern"
-        en = "Hired for <end:str>"
-        split = "\n"
-    }
     {
         mode = "pattern"
-        en = "Hired for <money:img><hire:int>."
-        ru = "Нанят за <money><hire>."
+        en = "+<x:int> damage"
+        ru = "+<x> урона (плюс)"
     }
     {
         mode = "pattern"
-        en = "Spent <spent:str>"
-        ru = "Потратил <spent>"
+        en = "-<x:int> damage"
+        ru = "-<x> урона (минус)"
     }
-    // {
-    //     mode = "pattern"
-    //     en = "<start:str>\nTCO ~ <end:str>"
-    //     split = "\n"
-    // }
     {
         mode = "pattern"
-        en = "TCO ~ <money:img><total:int>"
-        ru = "TCO ~ <money><total>"
+        en = "<x:str> damage"
+        ru = "<x> урона"
     }
 ])
-assertTr("Hired for [img]...[/img]171.", "Нанят за [img]...[/img]171.")
-assertTr("Hired for [img]...[/img]171.\nSpent 45\nTCO ~ [img]...[/img]267",
-         "Нанят за [img]...[/img]171.\nПотратил 45\nTCO ~ [img]...[/img]267")
-
+def.adaptive = true;
+def.reorderEvery = 4;
+foreach (i in [1 2 3 4]) assertTr("-" + i + " damage", "-" + i + " урона (минус)");
+assertEq(def.maps.ru.rules.damage.map(@(r) r.en),
+         ["-<x:int> damage", "+<x:int> damage", "<x:str> damage"]);
+assertTr("+5 damage", "+5 урона (плюс)");
+assertTr("7 damage", "7 урона");
+foreach (i in [5 6 7 8 9 10]) assertTr(i + " damage", i + " урона");
+assertEq(def.maps.ru.rules.damage.map(@(r) r.en),
+         ["-<x:int> damage", "+<x:int> damage", "<x:str> damage"]);
+// Hits are dropped when pairs are added
+def.add(rosetta, [{en = "Hello" ru = "Привет"}]);
+assertEq(def.ruleHits.len(), 0);
+def.adaptive = false;
+def.reorderEvery = 1000;
+
+// Negative cache
+setup({
+    en = "Hello"
+    ru = "Привет"
+})
+assertTr("Hello there", "Hello there");
+assert("Hello there" in def.missed);
+assertTr("Hello there", "Hello there");
+assertTr("Hello", "Привет"); // Not in the way of literals
+setup({
+    en = "Hello there"
+    ru = "Привет всем"
+})
+assertEq(def.missed.len(), 0);
+assertTr("Hello there", "Привет всем");
 
+// Profiling
+setup({
+    mode = "pattern"
+    en = "<title:str> (Failed)"
+    ru = "<title:t> (Провал)"
+})
+local translate = def.translate;
+def.translate = def.profiled("translate", translate);
+assertTr("Hello (Failed)", "Hello (Failed)");
+assertTr("Bye", "Bye");
+local rec = def.profile.translate, slowest = rec.slowest.map(@(s) s[1]);
+slowest.sort();
+assertEq(rec.calls, 2); // Nested translate() for :t is not counted
+assertEq(slowest, ["Bye", "Hello (Failed)"]);
+def.dumpProfile();
+def.translate = translate;
+def.profile = {};
+// Tooltips
 setup([
     {
-        // local text = "Was " + Str.join(", ", desc);
-        mode = "pattern"
-        en = "Was <middle:str> times"
-        function use(_str, _m) {
-            return "Был " + ::Rosetta.useSplit(this, ", ", _m.middle + " times")
-        }
-    }
-    {
-        // .map(@(n) format("%s %d times", n, effects[n]));
-        plural = "n"
-        en = "<effect:str> <n:int> times"
-        n1 = "<effect:t> <n> раз"
-        n2 = "<effect:t> <n> раза"
-        n5 = "<effect:t> <n> раз"
+        en = "Hello"
+        ru = "Привет"
     }
     {
-        en = "charmed"
-        ru = "зачарован"
+        mode = "pattern"
+        en = "Has a range of <range:int> tiles"
+        ru = "Дальность <range> клеток"
     }
+]);
+assertEq(def.translateMany(["Hello", "Has a range of 3 tiles", "Bye"]),
+         ["Привет", "Дальность 3 клеток", "Bye"]);
+local makeTooltip = @() [
+    {id = 1, type = "title", text = "Hello"}
+    {id = 2, type = "text", icon = "ui/icons/vision.png", text = "Has a range of 3 tiles"}
+    {id = 3, type = "hint"}
+];
+local expected = makeTooltip();
+expected[0].text = "Привет";
+expected[1].text = "Дальность 3 клеток";
+assertEq(def.translateTooltip(makeTooltip()), expected);
+assertEq(def.tooltipCache.len(), 1);
+def.maps.ru.strs.Hello = "Здравствуй"; // Not seen, since it's cached
+assertEq(def.translateTooltip(makeTooltip()), expected);
+setup({
+    en = "Hello"
+    ru = "Здорово"
+})
+assertEq(def.tooltipCache.len(), 0);
+assertEq(def.translateTooltip(makeTooltip())[0].text, "Здорово");
+
+// Inactive languages are only loaded when activated
+local rosettaEs = {mod = rosetta.mod, lang = "es"};
+setup({
+    en = "Hello"
+    ru = "Привет"
+})
+def.add(rosettaEs, [{en = "Hello", es = "Hola"}]);
+assert(!("es" in def.maps));
+assertEq(def.pending.es.len(), 1);
+def.activate("es");
+assertEq(def.pending.len(), 0);
+assertTr("Hello", "Hola");
+def.add(rosettaEs, [{mode = "pattern", en = "Hello, <name:str>", es = "Hola, <name>"}]);
+assertTr("Hello, Bob", "Hola, Bob");
+def.activate("ru");
+assertTr("Hello", "Привет");
+
+// Cached getters, objects are mocked with tables, so getters are called with them as this
+setup([
     {
-        en = "swallowed"
-        ru = "проглочен"
+        en = "Wiederganger"
+        ru = "Восставший"
     }
     {
-        en = "netted"
-        ru = "спутан"
+        id = "scripts/mock/12.Description"
+        ru = "Описание"
     }
-    {
-        en = "stunned"
-        ru = "оглушён"
+]);
+local getName = @() m.Name;
+local actor = {
+    m = {Name = "Wiederganger", ClassNameHash = 12}
+    getName = def.simpleGetter("getName")(getName)
+    getDescription = def.idGetter("getDescription", "Description")(@() "Whatever")
+}
+assertEq(actor.getName(), "Восставший");
+assertEq(actor.m.RosettaCache.getName, {Wiederganger = "Восставший"});
+assertEq(actor.getDescription(), "Описание");
+actor.m.Name = "Bob";
+assertEq(actor.getName(), "Bob");
+setup({
+    en = "Bob"
+    ru = "Боб"
+})
+assertEq(actor.getName(), "Боб"); // New generation
+
+local actors = ["Wiederganger", "Bob", "Necromancer", "Hedge Knight"].map(@(name) ({
+    m = {Name = name}
+    getName = def.simpleGetter("getName")(getName)
+    getNameUncached = @() def._(getName())
+}));
+local function benchGetter(_getter) {
+    local start = clock();
+    for (local n = 0; n < 20000; n++) {
+        foreach (a in actors) a[_getter]();
     }
-])
-assertTr("Was stunned 2 times, swallowed 5 times", "Был оглушён 2 раза, проглочен 5 раз")
+    return clock() - start;
+}
+print(format("getName: cached %.3fs, uncached %.3fs\n",
+    benchGetter("getName"), benchGetter("getNameUncached")));
 
 
-// setup({
-//     mode = "pattern"
-//     en = "Level <lvl:int>, Health <hp:val>%" // val slurps %
-//     ru = "Уровень <lvl>, Здоровье <hp>%"
-// })
-// assertTr("Level 3, Health 100%", "Уровень 3, Здоровье 100%")
+// Compiled pack loads the same as the source, make test compiles it with rosetta.py --compile
+local compiled = getenv("ROSETTA_COMPILED");
+if (compiled) {
+    def.maps = {};
+    dofile("rosetta/pack_ru.nut", true);
+    local expected = def.maps;
+    def.maps = {};
+    dofile(compiled, true);
+    assertEq(def.maps, expected);
+    assertTr("Wiederganger Bob", "Восставший Bob");
+}
 
 
 print("Tests OK\n");
@@ -0,0 +1,341 @@
+// Translation cases shared by test.nut and test_runtime.py, so that the runtime and its Python
+// port in runtime.py are checked against the same thing. Only literals here, no functions.
+::RosettaTestCases <- [
+    // Translate via pattern
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "Has a range of <range:int> tiles"
+            ru = "Дальность <range> клеток"
+        }]
+        cases = [
+            ["Has a range of 5 tiles", "Дальность 5 клеток"]
+        ]
+    }
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "Has a range of <open:tag><range:int><close:tag> tiles"
+            ru = "Дальность <open><range><close> клеток"
+        }]
+        cases = [
+            ["Has a range of [b]5[/b] tiles", "Дальность [b]5[/b] клеток"]
+        ]
+    }
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "Has a range of <range:int_tag> tiles"
+            ru = "Дальность <range> клеток"
+        }]
+        cases = [
+            ["Has a range of [b]5[/b] tiles", "Дальность [b]5[/b] клеток"]
+            ["it Has a range of [b]5[/b] tiles", "it Has a range of [b]5[/b] tiles"] // prefix
+            ["Has a range of [b]5[/b] tiles.", "Has a range of [b]5[/b] tiles."] // suffix
+        ]
+    }
+
+    // plurals
+    {
+        pairs = [{
+            plural = "range"
+            en = "Has a range of <range:int> tiles"
+            n1 = "Дальность - <range> клетка"
+            n2 = "Дальность - <range> клетки"
+            n5 = "Дальность - <range> клеток"
+        }]
+        cases = [
+            ["Has a range of 1 tiles", "Дальность - 1 клетка"]
+            ["Has a range of 31 tiles", "Дальность - 31 клетка"]
+            ["Has a range of 23 tiles", "Дальность - 23 клетки"]
+            ["Has a range of 5 tiles", "Дальность - 5 клеток"]
+            ["Has a range of 14 tiles", "Дальность - 14 клеток"]
+        ]
+    }
+    {
+        pairs = [{
+            plural = "range"
+            en = "Has a range of <range:int_tag> tiles"
+            n1 = "Дальность - <range> клетка"
+            n2 = "Дальность - <range> клетки"
+            n5 = "Дальность - <range> клеток"
+        }]
+        cases = [
+            ["Has a range of [b]4[/b] tiles", "Дальность - [b]4[/b] клетки"]
+        ]
+    }
+
+    // Reverse labels and no proper contenKey
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "<x:int> and <y:int>"
+            ru = "<y> и <x>"
+        }]
+        cases = [
+            ["11 and 22", "22 и 11"]
+        ]
+    }
+    // This works using "" rule key
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "Some<x:int>"
+            ru = "Типа<x>"
+        }]
+        cases = [
+            ["Some2", "Типа2"]
+        ]
+    }
+    // Label match as a potential contentKey
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "<name:word> says hello"
+            ru = "<name> передаёт привет"
+        }]
+        cases = [
+            ["Yarg says hello", "Yarg передаёт привет"]
+            ["Йарг says hello", "Йарг передаёт привет"] // Check matching non-english words
+        ]
+    }
+
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "with <others:str> you only"
+            ru = "с <others> вы только"
+        }]
+        cases = [
+            ["with Nimble you only", "с Nimble вы только"]
+            // Multi-word :str -- exposed Squirrel's regexp backtracking bug, motivated matchParts().
+            ["with Nimble and Battle Forged you only", "с Nimble and Battle Forged вы только"]
+        ]
+    }
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "with <item:str><num:int> item"
+            ru = "с предметом <item><num>"
+        }]
+        cases = [
+            ["with Sword+1 item", "с предметом Sword+1"]
+            ["with Battle Axe+1 item", "с предметом Battle Axe+1"]
+        ]
+    }
+
+    // :line -- like :str but bounded by \n; eats the trailing \n (or end of string)
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "Spent <x:line>"
+            ru = "Потратил <x>"
+        }]
+        cases = [
+            ["Spent foo", "Потратил foo"]
+            // The fix: :line does not cross \n -- with :str the rule would greedy-eat past
+            // the newline and translate "Spent foo\nrest" as "Потратил foo\nrest".
+            ["Spent foo\nrest", "Spent foo\nrest"] // didn't match, returned as-is
+        ]
+    }
+    // :line eats the trailing \n; the literal that follows starts AFTER it.
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "<x:line>then <y:str>"
+            ru = "<x>далее <y>"
+        }]
+        cases = [
+            ["first\nthen rest", "first\nдалее rest"]
+        ]
+    }
+    // Limitation: :line is greedy and the engine doesn't backtrack -- same family
+    // of issues as :str via single regex. Don't place :line before a non-\n anchor;
+    // it will eat it whole and the rule won't match.
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "<x:line> tail"
+            ru = "<x> хвост"
+        }]
+        cases = [
+            ["abc tail", "abc tail"] // didn't match
+        ]
+    }
+
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "Use <open:tag><ap:int> AP<close:tag> and <fat:str_tag> less fatigue."
+            ru = "Тратит только <open><ap> ОД<close> и на <fat> меньше выносливости."
+        }]
+        cases = [
+            ["Use [color=#135213]4 AP[/color] and [color=#135213]25%[/color] less fatigue.",
+             "Тратит только [color=#135213]4 ОД[/color] и на [color=#135213]25%[/color] меньше выносливости."]
+        ]
+    }
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "this perk has a <chance:val_tag> chance"
+            ru = "По достижении 5 уровня есть <chance> шанс"
+        }]
+        cases = [
+            ["this perk has a [color=#135213]70%[/color] chance",
+             "По достижении 5 уровня есть [color=#135213]70%[/color] шанс"]
+        ]
+    }
+
+    // Double translation
+    {
+        pairs = [
+            {
+                plural = "uses"
+                en = "Used nine lives <uses:int> times<end:str>"
+                n1 = "Использовал 'Девять жизней' <uses> раз<end:t>"
+                n2 = "Использовал 'Девять жизней' <uses> раза<end:t>"
+                n5 = "Использовал 'Девять жизней' <uses> раз<end:t>"
+            }
+            {
+                mode = "pattern"
+                en = "Used nine lives once<end:str>"
+                ru = "Однажды использовал 'Девять жизней'<end:t>"
+            }
+            {
+                en = ", died every time"
+                ru = ", помирал каждый раз"
+            }
+            {
+                en = ", died anyway"
+                ru = ", всё равно подох"
+            }
+            {
+                plural = "saves"
+                en = ", survived <saves:int> times"
+                n1 = ", выжил <saves> раз"
+                n2 = ", выжил <saves> раза"
+                n5 = ", выжил <saves> раз"
+            }
+            {
+                en = ", survived once"
+                ru = ", выжил разок"
+            }
+        ]
+        cases = [
+            ["Used nine lives 2 times, survived once",
+             "Использовал 'Девять жизней' 2 раза, выжил разок"]
+            ["Used nine lives 7 times, died every time",
+             "Использовал 'Девять жизней' 7 раз, помирал каждый раз"]
+            ["Used nine lives 7 times, survived 3 times",
+             "Использовал 'Девять жизней' 7 раз, выжил 3 раза"]
+            ["Used nine lives once, died anyway",
+             "Однажды использовал 'Девять жизней', всё равно подох"]
+        ]
+    }
+
+    // Non-obvious rule keys
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "<open:tag>is not perfect<close:tag>, i.e. "
+            ru = "<open>не идеально<close>, т.е. "
+        }]
+        cases = [
+            ["[b]is not perfect[/b], i.e. ", "[b]не идеально[/b], т.е. "]
+        ]
+    }
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "<num:int> day<s:str>"
+            // en = "<num:int> day<|s>"
+            ru = "<num> дней"
+        }]
+        cases = [
+            ["1 day", "1 дней"]
+            ["5 days", "5 дней"]
+        ]
+    }
+    {
+        pairs = [{
+            plural = "days"
+            en = "Light Wounds (<days:int> day<s:str>)"
+            n1 = "Лёгкие раны (<days> день)"
+            n2 = "Лёгкие раны (<days> дня)"
+            n5 = "Лёгкие раны (<days> дней)"
+        }]
+        cases = [
+            ["Light Wounds (1 day)", "Лёгкие раны (1 день)"]
+            ["Light Wounds (2 days)", "Лёгкие раны (2 дня)"]
+        ]
+    }
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "<num:int> day<s:str><img:tag>"
+            ru = "<num> дней<img>"
+        }]
+        cases = [
+            ["1 day[img]", "1 дней[img]"]
+            ["5 days[img=123]", "5 дней[img=123]"]
+        ]
+    }
+
+    {
+        pairs = [
+            {
+                mode = "pattern"
+                en = "<title:str> (Failed)"
+                ru = "<title:t> (Провал)"
+            }
+            {
+                en = "Something"
+                ru = "Что-то"
+            }
+        ]
+        cases = [
+            ["Something (Failed)", "Что-то (Провал)"]
+        ]
+    }
+    // Don't allow partial
+    {
+        pairs = [{
+            mode = "pattern"
+            en = "<title:str> (Failed)"
+            ru = "<title:t> (Провал)"
+        }]
+        cases = [
+            ["Something (Failed)", "Something (Failed)"]
+        ]
+    }
+
+    {
+        pairs = [
+            {
+                // mode = "pattern"
+                en = "Hired for <end:str>"
+                split = "\n"
+            }
+            {
+                mode = "pattern"
+                en = "Hired for <money:img><hire:int>."
+                ru = "Нанят за <money><hire>."
+            }
+            {
+                mode = "pattern"
+                en = "Spent <spent:str>"
+                ru = "Потратил <spent>"
+            }
+            {
+                mode = "pattern"
+                en = "TCO ~ <money:img><total:int>"
+                ru = "TCO ~ <money><total>"
+            }
+        ]
+        cases = [
+            ["Hired for [img]...[/img]171.", "Нанят за [img]...[/img]171."]
+            ["Hired for [img]...[/img]171.\nSpent 45\nTCO ~ [img]...[/img]267",
+             "Нанят за [img]...[/img]171.\nПотратил 45\nTCO ~ [img]...[/img]267"]
+        ]
+    }
+]
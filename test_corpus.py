@@ -0,0 +1,15 @@
+from corpus import read_corpus
+
+
+def test_read_corpus_log():
+    log = '\n'.join([
+        'junk',
+        '<div class="text">rosetta: NOT FOUND Fear &amp; Loathing</div>',
+        'rosetta: NOT FOUND Wiederganger Bob',
+        r'rosetta: TRANSLATING = "Some \"quoted\"\nthing"',
+    ])
+    assert read_corpus(log) == ['Fear & Loathing', 'Wiederganger Bob', 'Some "quoted"\nthing']
+
+
+def test_read_corpus_plain():
+    assert read_corpus('Hello\n\nTwo\\nlines\n') == ['Hello', 'Two\nlines']
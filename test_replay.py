@@ -0,0 +1,21 @@
+from replay import replay_python
+
+
+def test_replay_python(tmp_path):
+    pack = tmp_path / "rosetta_ru.nut"
+    pack.write_text('''
+::Rosetta.add({mod = {id = "mod_test"}, lang = "ru"}, [
+    {
+        en = "Hello"
+        ru = "Привет"
+    }
+    {
+        mode = "pattern"
+        en = "Wiederganger <name:str>"
+        ru = "Восставший <name>"
+    }
+]);
+''')
+    result = replay_python([pack], ["Hello", "Wiederganger Bob", "Bye"], repeat=3)
+    assert result["stats"] == {"hits": 1, "rule_hits": 1, "misses": 1}
+    assert result["rules"]["Wiederganger <name:str>"][1] == 1
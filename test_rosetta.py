@@ -1,13 +1,16 @@
 from pprint import pprint
 import io
 import re
+from pathlib import Path
 from textwrap import dedent
 
 import sys
 import pytest
-from rosetta import extract, load_ref, run_check, check, OPTS, \
-    SEEN, REF_PAIRS, REF_RULES, CODE_RULES, REF_BLOCKS, KNOWN_WORDS, _refresh_code, \
-    DUP_CAPTURE_BLOCKS, _dup_captures, BAD_PATTERN_BLOCKS, _bad_pattern_captures
+from rosetta import extract, load_ref, iter_ref_tokens, run_check, check, compile_file, \
+    expand_file, extract_misses, merge_files, extract_old, serve_line, SERVE_METHODS, \
+    iter_mod_files, extract_path, OPTS, SEEN, REF_PAIRS, REF_RULES, REF_RULE_LIST, CODE_RULES, \
+    REF_BLOCKS, KNOWN_WORDS, _refresh_code, \
+    DUP_CAPTURE_BLOCKS, _dup_captures, BAD_PATTERN_BLOCKS, _bad_pattern_captures, FUZZY
 
 OPTS['context'] = True
 OPTS['debug'] = True
@@ -393,6 +396,363 @@ def test_load_ref_commas(clear_ref):
     assert set(REF_PAIRS) == {"Hello", "World"}
     assert list_pairs('text = "Hello"') == ['\n    {en = "Hello", ru = "Привет"},']
 
+def test_load_ref_verbatim(clear_ref):
+    load_ref(io.StringIO(dedent('''\
+        local pairs = [
+            {en = @"Say ""hi"" {now}" ru = @"Скажи ""привет"" {сейчас}"}
+            {en = "Bye" ru = @"Пока\\"}
+        ]
+    ''')))
+    assert set(REF_PAIRS) == {'Say "hi" {now}', "Bye"}
+
+def test_ref_tokens_unbalanced():
+    text = 'local pairs = [{en = "Hello" ru = \'Привет}, // don\'t\n {en = @"Bye"" ru = "Пока}]'
+    assert "".join(m for m, _, _ in iter_ref_tokens(text)) == text
+
+def test_ref_rules_rarest_key(clear_ref):
+    load_ref(io.StringIO(dedent('''\
+        local pairs = [
+            {
+                mode = "pattern"
+                en = "Damage to <x:str> armor"
+                ru = "Урон <x> броне"
+            }
+            {
+                mode = "pattern"
+                en = "Damage dealt <x:int>"
+                ru = "Нанесено урона <x>"
+            }
+        ]''')))
+    [block] = list_pairs('text = "Damage dealt " + dmg')
+    assert 'Нанесено урона' in block
+    assert set(REF_RULES) == {"armor", "dealt"}
+
+def test_compile(tmp_path):
+    from runtime import Rosetta, parse_nut
+    source = tmp_path / "rosetta_ru.nut"
+    source.write_text(dedent('''\
+        local rosetta = {mod = {id = "mod_test"}, lang = "ru"}
+        local pairs = [
+            {
+                en = "Hello"
+                ru = "Привет"
+            }
+            {
+                id = "perk.name"
+                ru = "Имя"
+            }
+            {
+                plural = "n"
+                en = "<effect:str> <n:int> times"
+                n1 = "<effect:t> <n> раз"
+                n2 = "<effect:t> <n> раза"
+                n5 = "<effect:t> <n> раз"
+            }
+            {
+                mode = "pattern"
+                en = "Was <middle:str> times"
+                function use(_str, _m) {
+                    return "Был " + _m.middle
+                }
+            }
+        ]
+        ::Rosetta.add(rosetta, pairs);
+    '''))
+    compiled = tmp_path / "compiled_ru.nut"
+    compiled.write_text(compile_file(source))
+    assert "::Rosetta.addCompiled(rosetta, pairs);" in compiled.read_text()
+
+    expected, actual = Rosetta(), Rosetta()
+    expected.load(source)
+    actual.load(compiled)
+    assert actual.maps == expected.maps
+    assert parse_nut(compiled.read_text()).vars["pairs"]["rules"][1]["use"].source \
+        .startswith("function use(_str, _m)")
+
+    actual.activate("ru")
+    assert actual.translate("Hello 3 times") == "Привет 3 раза"
+
+def test_expand(tmp_path):
+    from runtime import parse_nut
+    source = tmp_path / "rosetta_ru.nut"
+    source.write_text(dedent('''\
+        local rosetta = {mod = {id = "mod_test", version = "1.0"}, lang = "ru"}
+        local pairs = [
+            {
+                en = "Hello"
+                ru = "Привет"
+            }
+            {
+                plural = "n"
+                en = "Hit <n:int> times"
+                n1 = "Попал <n> раз"
+                n2 = "Попал <n> раза"
+                n5 = "Попал <n> раз"
+            }
+            {
+                mode = "pattern"
+                en = "<title:str> (Failed)"
+                ru = "<title:t> (Провал)"
+            }
+        ]
+        ::Rosetta.add(rosetta, pairs);
+    '''))
+    corpus = tmp_path / "corpus.txt"
+    corpus.write_text("Hit 3 times\nHello (Failed)\nHit 2 times\nHit 3 times\nHello\nBye\n")
+
+    # Only the rule not depending on other pairs, the most frequent first
+    OPTS["top"] = "1"
+    try:
+        pairs = parse_nut(expand_file(source, str(corpus))).vars["pairs"]
+    finally:
+        OPTS["top"] = None
+    assert pairs == [{"en": "Hit 3 times", "ru": "Попал 3 раза"}]
+
+    pairs = parse_nut(expand_file(source, "0..2")).vars["pairs"]
+    assert pairs == [{"en": "Hit 0 times", "ru": "Попал 0 раз"},
+                     {"en": "Hit 1 times", "ru": "Попал 1 раз"},
+                     {"en": "Hit 2 times", "ru": "Попал 2 раза"}]
+
+def test_extract_misses(tmp_path, clear_ref):
+    log = tmp_path / "log.html"
+    log.write_text("\n".join([
+        '<div class="text">rosetta: NOT FOUND Has a range of 3 tiles</div>',
+        '<div class="text">rosetta: NOT FOUND Hello</div>',
+        '<div class="text">Hello</div>',
+        '<div class="text">rosetta: NOT FOUND Gains [color=#135213]+10%[/color] for 2 turns</div>',
+        '<div class="text">rosetta: NOT FOUND Gains [color=#135213]+5%[/color] for 1 turns</div>',
+        '<div class="text">rosetta: NOT FOUND Fear &amp; Loathing</div>',
+        '<div class="text">rosetta: NOT FOUND Greet Bob</div>',
+        '<div class="text">rosetta: NOT FOUND Tom &amp; Jerry',
+        'continued</div>',
+    ]))
+    ref = tmp_path / "rosetta_ru.nut"
+    ref.write_text('''local pairs = [
+        {
+            en = "Hello"
+            ru = "Привет"
+        }
+        {
+            mode = "pattern"
+            en = "Has a range of <range:int> tiles"
+            ru = "Дальность <range> клеток"
+        }
+        {
+            mode = "pattern"
+            en = "Greet <name:str>"
+            ru = "Поприветствовать <name>"
+        }
+    ]
+    ::Rosetta.add({mod = {id = "mod_test"}, lang = "ru"}, pairs);''')
+    load_ref(str(ref))
+    OPTS["ref"] = str(ref)
+    try:
+        lines = []
+        extract_misses([log], out=lines.append)
+    finally:
+        OPTS["ref"] = None
+    assert lines[1:-1] == [
+        '    // NOT FOUND 2 times, i.e. "Gains [color=#135213]+10%[/color] for 2 turns"',
+        '    {\n        mode = "pattern"\n        en = "Gains <n:val_tag> for <n2:int> turns"\n'
+        '        ru = ""\n    }',
+        '    {\n        en = "Fear & Loathing"\n        ru = ""\n    }',
+        '    {\n        en = "Tom & Jerry"\n        ru = ""\n    }',
+    ]
+
+def test_merge(tmp_path):
+    from runtime import parse_nut
+    files = [tmp_path / "a.nut", tmp_path / "b.nut"]
+    files[0].write_text(dedent('''\
+        local rosetta = {mod = {id = "mod_a"}, lang = "ru"}
+        local pairs = [
+            {
+                en = "Hello"
+                ru = "Привет"
+            }
+            {
+                mode = "pattern"
+                en = "Damage dealt <x:int>"
+                ru = "Нанесено <x>"
+            }
+            {
+                mode = "pattern"
+                en = "Damage to <x:str> armor"
+                ru = "Урон <x> броне"
+            }
+            // en = "Skipped"
+        ]
+        ::Rosetta.add(rosetta, pairs);
+    '''))
+    files[1].write_text(dedent('''\
+        local pairs = [
+            {
+                // text = "Hello"
+                en = "Hello"
+                ru = "Привет2"
+            }
+            {
+                id = "perk.name"
+                ru = "Имя // not a comment"
+            }
+            {
+                id = "perk.other"
+                en = "Hello"
+                ru = "Здравствуй"
+            }
+            {
+                mode = "pattern"
+                en = "Damage dealt <x:int>"
+                ru = "Урона нанесено <x>"
+            }
+        ]
+        ::Rosetta.add(::Mod.Rosetta, pairs);
+    '''))
+    out = []
+    merge_files(files, out=out.append)
+    assert "// text = \"Hello\"" in out[0] and "// en = \"Skipped\"" in out[0]
+    pairs = parse_nut(out[0]).vars["pairs"]
+    # Same as in the runtime the last pair and the first rule win, rules keep their order,
+    # same en with an id is not a conflict
+    assert pairs == [
+        {"en": "Hello", "ru": "Привет2"},
+        {"id": "perk.name", "ru": "Имя // not a comment"},
+        {"id": "perk.other", "en": "Hello", "ru": "Здравствуй"},
+        {"mode": "pattern", "en": "Damage dealt <x:int>", "ru": "Нанесено <x>"},
+        {"mode": "pattern", "en": "Damage to <x:str> armor", "ru": "Урон <x> броне"},
+    ]
+
+    OPTS["strip"] = True
+    try:
+        out = []
+        merge_files(files, out=out.append)
+    finally:
+        OPTS["strip"] = False
+    assert "//" not in out[0].replace("// not a comment", "").replace('// en = "Skipped"', "")
+    assert '// en = "Skipped"' in out[0]
+    assert parse_nut(out[0]).vars["pairs"] == pairs
+
+def test_jsonl(tmp_path, clear_ref):
+    import json
+    mod = tmp_path / "mod.nut"
+    mod.write_text('local a = "Hello";\nlocal b = "Hello " + name;\n')
+    load_ref(io.StringIO('local pairs = [\n    {\n        en = "Hello"\n        ru = "Привет"\n    }\n]'))
+    SEEN.clear()
+    OPTS["format"] = "jsonl"
+    try:
+        lines = []
+        extract_path(mod, out=lines.append)
+    finally:
+        OPTS["format"] = "nut"
+    assert [json.loads(line) for line in lines] == [
+        {"file": str(mod), "line": 1, "en": "Hello", "mode": None, "ru": "Привет", "code": None,
+         "context": "a", "ref": True},
+        {"file": str(mod), "line": 2, "en": "Hello <name>", "mode": "pattern", "ru": "",
+         "code": ['local b = "Hello " + name;'], "context": "b", "ref": False},
+    ]
+
+def test_iter_mod_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # Skip rules look at the whole path, which has test in it
+    root = Path("scripts") / "mod"  # A scripts dir above the mod root doesn't matter
+    for name in ["scripts/b.nut", "scripts/a/z.nut", "scripts/a.nut", "scripts/ui/x.nut",
+                 "scripts/mod_rosetta/x.nut", "scripts/mocks.nut", "gfx/x.nut", "!!redirect/x.nut",
+                 "scripts/README.md"]:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text("")
+    skipped = []
+    files = list(iter_mod_files(root, on_skip=skipped.append))
+    assert files == [f for f in sorted(root.glob("**/*.nut"))
+                     if f.parts[-2] not in {"gfx", "!!redirect", "mod_rosetta"}
+                     and f.name != "mocks.nut"]
+    assert [f.relative_to(root).as_posix() for f in files] \
+        == ["scripts/a/z.nut", "scripts/a.nut", "scripts/b.nut", "scripts/ui/x.nut"]
+    assert len(skipped) == 4
+    # Walking scripts/ itself still keeps its ui/
+    assert Path("scripts/mod/scripts/ui/x.nut") in iter_mod_files(root / "scripts")
+
+def test_extract_old(tmp_path, monkeypatch, capsys):
+    import zipfile
+    # Relative paths, "test" in tmp_path would get everything skipped
+    monkeypatch.chdir(tmp_path)
+    en = Path("en")
+    (en / "scripts").mkdir(parents=True)
+    (en / "scripts" / "a.nut").write_text(dedent('''\
+        this.m.Name = "Sword";
+        function getTooltip() {
+            return ["A fine sword", "Hits hard", "Already seen"];
+        }
+        function onUse() {
+            this.log("Sword");
+            this.log("Used it");
+        }
+    '''))
+    (en / "scripts" / "test_a.nut").write_text('local s = "Skipped file"')
+    old = Path("old.zip")
+    with zipfile.ZipFile(old, "w") as zf:
+        zf.writestr("scripts/a.nut", dedent('''\
+            this.m.Name = "Меч";
+            function getTooltip() {
+                return ["Хороший меч", "Бьёт больно"];
+            }
+            function onUse() {
+                this.log("Меч");
+                this.log("Использован");
+            }
+        '''))
+
+    SEEN.clear()
+    SEEN.add("Already seen")
+    out = []
+    extract_old(en, old, out=out.append)
+    assert out[1:-1] == [
+        "    // FILE: scripts/a.nut",
+        '    // context: m.Name\n    {\n        en = "Sword"\n        ru = "Меч"\n    }',
+        '    // context: getTooltip\n    {\n        en = "A fine sword"\n        ru = ""\n    }',
+        '    // context: getTooltip\n    {\n        en = "Hits hard"\n        ru = ""\n    }',
+        "    // Strings extracted for this context from the translated version of the mod.\n"
+        "    // Cannot automatically tell which of them correspond to which English phrases above.\n"
+        '    // "Хороший меч"\n    // "Бьёт больно"',
+        '    // context: onUse.log()\n    {\n        en = "Used it"\n        ru = "Использован"\n    }',
+    ]
+    assert "parallel: scripts/a.nut getTooltip: 3 original strings, 2 old strings, " \
+        "emitted old candidates as comments" in capsys.readouterr().err
+
+def test_serve(tmp_path, monkeypatch, clear_ref):
+    import json
+    mod = tmp_path / "mod.nut"
+    mod.write_text('local a = "Hello";\nlocal b = "Something new";\n')
+    ref = tmp_path / "rosetta_ru.nut"
+    ref.write_text('local pairs = [\n    {\n        en = "Hello"\n        ru = "Привет"\n    }\n]')
+
+    def call(method, **params):
+        response = json.loads(serve_line(json.dumps({"id": 1, "method": method, "params": params})))
+        return response.get("result", response.get("error"))
+
+    assert call("reload_reference", ref=str(ref))["pairs"] >= 1
+    try:
+        assert call("lookup_en", en="Hello") == '    {\n        en = "Hello"\n        ru = "Привет"\n    }'
+        assert [b.split("en = ")[1] for b in call("check_file", path=str(mod))["new"]] \
+            == ['"Something new"\n        ru = ""\n    }']
+        # Refs used by code and seen strings are reset between requests
+        assert call("extract_file", path=str(mod)) == call("extract_file", path=str(mod))
+
+        mod.write_text('local b = "Something new";\nlocal c = "Other";\n')
+        assert len(call("check_file", path=str(mod))["new"]) == 2
+        assert call("nope")["code"] == -32601
+        assert call("lookup_en", text="Hello")["code"] == -32602
+        # A bad reference leaves the previous one in place
+        assert call("reload_reference", ref=str(tmp_path / "nope.nut"))["code"] == -32000
+        assert OPTS["ref"] == str(ref)
+        assert call("lookup_en", en="Hello") == '    {\n        en = "Hello"\n        ru = "Привет"\n    }'
+        # Errors inside a method are not taken for bad params
+        def broken(path):
+            return len(None)
+        monkeypatch.setitem(SERVE_METHODS, "extract_file", broken)
+        error = call("extract_file", path=str(mod))
+        assert error["code"] == -32000 and "Traceback" in error["message"]
+    finally:
+        OPTS["ref"] = None
+    assert json.loads(serve_line("{"))["error"]["code"] == -32700
+
 def test_load_ref_newlines(clear_ref):
     block = dedent('''\
         {
@@ -665,6 +1025,54 @@ def test_silent_pack(clear_ref, monkeypatch):
     assert list_en('text = "[color=" + Color.green + "]+" + this.m.Init + "[/color] Initiative"') == []
 
 
+def test_fuzzy(clear_ref):
+    load_ref(io.StringIO(dedent('''\
+        local pairs = [
+            {
+                en = "The old man looks at you with tired eyes and says nothing at all."
+                ru = "Старик смотрит на тебя усталыми глазами и ничего не говорит."
+            }
+        ]
+    ''')))
+    code = 'text = "The old man looks at you with sad eyes and says nothing at all."'
+    assert list_pairs(code) == [
+        '    // FUZZY 93%: "The old man looks at you with tired eyes and says nothing at all."\n'
+        '    {\n'
+        '        en = "The old man looks at you with sad eyes and says nothing at all."\n'
+        '        ru = "Старик смотрит на тебя усталыми глазами и ничего не говорит."\n'
+        '    }'
+    ]
+    assert list_en('text = "The young woman looks at you and says hello."') \
+        == ["The young woman looks at you and says hello."]
+
+def test_fuzzy_verbatim(clear_ref):
+    load_ref(io.StringIO(dedent('''\
+        local pairs = [
+            {
+                en = @"The old man looks at you with tired eyes and says ""nothing"" at all."
+                ru = @"Старик смотрит на тебя усталыми глазами и ""ничего"" не говорит."
+            }
+        ]
+    ''')))
+    code = 'text = "The old man looks at you with sad eyes and says \\"nothing\\" at all."'
+    [block] = list_pairs(code)
+    assert '\n        en = "The old man looks at you with sad eyes and says \\"nothing\\" at all."\n' \
+        in block
+    assert "tired" not in block.split("\n", 1)[1]
+
+def test_fuzzy_short(clear_ref):
+    load_ref(io.StringIO('local pairs = [{en = "Hello there, friend" ru = "Привет, друг"}]'))
+    assert list_en('text = "Hello there, enemy"') == ["Hello there, enemy"]
+
+def test_check_fuzzy_is_new(clear_ref):
+    new_blocks, unmatched_blocks, _ = _check(
+        'text = "Iron sword of the old king, it is slightly rusty"',
+        '{en = "Iron sword of the old king, it is very rusty" ru = "Железный меч старого короля, слегка заржавел"}',
+    )
+    assert len(new_blocks) == 1 and "FUZZY" in new_blocks[0]
+    assert len(unmatched_blocks) == 1
+
+
 # _refresh_code tests
 
 def test_refresh_code_no_comments():
@@ -855,11 +1263,13 @@ def clear_ref():
     yield
     REF_PAIRS.clear()
     REF_RULES.clear()
+    REF_RULE_LIST.clear()
     CODE_RULES.clear()
     REF_BLOCKS.clear()
     KNOWN_WORDS.clear()
     DUP_CAPTURE_BLOCKS.clear()
     BAD_PATTERN_BLOCKS.clear()
+    FUZZY.clear()
 
 def _check(code, ref):
     import tempfile
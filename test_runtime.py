@@ -0,0 +1,138 @@
+from pathlib import Path
+
+import pytest
+from runtime import Rosetta, RosettaError, parse_nut, NutExpr, NutFunction, \
+    Capture, SUB_RES
+
+CASES = parse_nut(Path(__file__).with_name("test_cases.nut").read_text()).vars["::RosettaTestCases"]
+DESC = {"mod": {"id": "mod_rosetta", "version": "1.0.0"}, "lang": "ru"}
+
+
+def setup(pairs):
+    rosetta = Rosetta()
+    rosetta.activate("ru")
+    rosetta.add(DESC, pairs)
+    return rosetta
+
+
+@pytest.mark.parametrize("case", CASES, ids=lambda c: c["pairs"][0]["en"])
+def test_cases(case):
+    rosetta = setup(case["pairs"])
+    for en, ru in case["cases"]:
+        assert rosetta.translate(en) == ru
+
+
+def test_parse_pattern():
+    assert Rosetta.parse_pattern("range <open:tag><range:int><close:tag>") == \
+        ["range ", Capture("open", "tag"), Capture("range", "int"), Capture("close", "tag")]
+    assert Rosetta.parse_pattern("1 ... <range:int>") == ["1 ... ", Capture("range", "int")]
+
+
+def test_rule_keys():
+    rosetta = Rosetta()
+    assert rosetta._rule_keys("Has a range of <range:int> tiles") == ["range", "tiles"]
+    assert rosetta._rule_keys("Some<x:int>") == [""]
+    assert rosetta._rule_keys("<open:tag>is not perfect<close:tag>, i.e. ") == ["perfect", "i.e."]
+
+
+def test_rarest_key():
+    rosetta = setup([
+        {"mode": "pattern", "en": "Damage to <x:str> armor", "ru": "Урон <x> броне"},
+        {"mode": "pattern", "en": "Damage dealt <x:int>", "ru": "Нанесено урона <x>"},
+        {"mode": "pattern", "en": "Some<x:int>", "ru": "Типа<x>"},
+    ])
+    assert rosetta.translate("Damage dealt 5") == "Нанесено урона 5"
+    assert {k: len(v) for k, v in rosetta.maps["ru"]["rules"].items()} \
+        == {"armor": 1, "dealt": 1, "": 1}
+
+
+def test_prefilter():
+    rule = Rosetta().make_rule("ru", {"mode": "pattern", "en": "Has <x:int> of <y:int> tiles",
+                                      "ru": "<x> <y>"})
+    assert [rule[k] for k in ("minLen", "prefix", "suffix", "literal")] \
+        == [14, "Has ", " tiles", " of "]
+
+
+def test_bad_rules():
+    with pytest.raises(RosettaError, match="Label type 'abc' is not supported"):
+        setup([{"mode": "pattern", "en": "has a <chance:abc> chance", "ru": "<chance>"}])
+    with pytest.raises(RosettaError, match="Label 'not_found' is in 'ru' but not in 'en'"):
+        setup([{"mode": "pattern", "en": "has a <chance:val> chance", "ru": "<not_found>"}])
+    with pytest.raises(RosettaError, match="Duplicate capture 'open' in 'en'"):
+        setup([{"mode": "pattern", "en": "<open:tag>+10%<close:tag> and <open:tag>",
+                "ru": "<open>+10%<close>"}])
+
+
+def test_empty_skipped():
+    rosetta = setup([{"en": "Hello", "ru": ""}, {"en": "Bye", "ru": "Пока"}])
+    assert rosetta.translate("Hello") == "Hello"
+    assert rosetta.translate("Bye") == "Пока"
+    assert rosetta.stats == {"hits": 1, "misses": 1, "rule_hits": 0, "rule_uses": 1}
+
+
+def test_line_regex_end():
+    # Squirrel $ is the end of a string, not before the last \n
+    assert SUB_RES["line"].match("abc\n").group() == "abc\n"
+
+
+def test_parse_nut():
+    nut = parse_nut('''
+local def = ::Rosetta;
+local rosetta = {
+    mod = {id = def.ID, version = def.Version}
+    author = "hackflow" // a comment
+    lang = "ru"
+}
+local pairs = [
+    {
+        // en = "Commented out"
+        en = "Hello, " + "there"
+        ru = @"Привет, ""там"""
+        n = -1.5
+    }
+    {
+        mode = "pattern"
+        en = "Was <middle:str> times"
+        function use(_str, _m) {
+            return "Был {" + _m.middle + "}"
+        }
+    }
+]
+::Rosetta.add(rosetta, pairs);
+this.m.Tooltip.add(rosetta);
+def.add(rosetta, pairs);
+''')
+    assert len(nut.calls) == 2  # Only Rosetta.add() calls, also via an alias
+    rosetta, pairs = map(nut.resolve, nut.calls[0].args)
+    assert rosetta["mod"] == {"id": NutExpr("def.ID"), "version": NutExpr("def.Version")}
+    assert rosetta["lang"] == "ru"
+    assert pairs[0] == {"en": "Hello, there", "ru": 'Привет, "там"', "n": -1.5}
+    assert isinstance(pairs[1]["use"], NutFunction)
+    assert pairs[1]["use"].source.endswith('+ "}"\n        }')
+
+
+def test_load(tmp_path):
+    file = tmp_path / "rosetta_ru.nut"
+    file.write_text('''
+local rosetta = {
+    mod = {id = "mod_test", version = "0.1.0"}
+    lang = "ru"
+}
+local pairs = [
+    {
+        en = "Hello"
+        ru = "Привет"
+    }
+    {
+        mode = "pattern"
+        en = "Was <middle:str> times"
+        function use(_str, _m) { return _str }
+    }
+]
+::Rosetta.add(rosetta, pairs);
+''')
+    rosetta = Rosetta()
+    rosetta.activate("ru")
+    rosetta.load(file)
+    assert rosetta.translate("Hello") == "Привет"
+    assert rosetta.translate("Was it 2 times") == "Was it 2 times"
@@ -0,0 +1,99 @@
+import pytest
+import xt
+from xt import mask, unmask, translate, Mock
+
+
+def test_mask():
+    assert mask("Has a range of [b]5[/b]") == ("Has a range of %0%%1%%2%", ["[b]", "5", "[/b]"])
+    assert mask("%name% hits %name% for +10%") == ("%0% hits %0% for %1%", ["%name%", "+10%"])
+    assert mask("<actor> heals") == ("%0% heals", ["<actor>"])
+    assert mask("[img]gfx/ui/icons/asset_money.png[/img]Costs") \
+        == ("%0%Costs", ["[img]gfx/ui/icons/asset_money.png[/img]"])
+    assert mask("No tokens") == ("No tokens", [])
+
+def test_mask_normalizes():
+    assert mask("%name% gains [color=#135213]+5%[/color] Resolve")[0] \
+        == mask("%person% gains [color=#8f1e1e]+7%[/color] Resolve")[0]
+
+def test_mask_keeps_counted_words():
+    # Russian word form depends on the number: 2 дня, 5 дней
+    assert mask("Lasts 2 days") == ("Lasts 2 days", [])
+    assert mask("Lasts [b]5[/b] days")[0] == "Lasts %0%5%1% days"
+    assert mask("Lasts 2 days") != mask("Lasts 5 days")
+    assert mask("Costs 1.5, hits for 7.") == ("Costs %0%, hits for %1%.", ["1.5", "7"])
+
+def test_unmask():
+    masked, tokens = mask("%name% hits %target% for 10% of damage")
+    assert unmask("%1% получает от %0% 10% урона".replace("10%", "%2%"), tokens) \
+        == "%target% получает от %name% 10% урона"
+
+def test_unmask_broken():
+    masked, tokens = mask("%name% hits %target%")
+    assert unmask("%0% бьёт", tokens) is None  # lost one
+    assert unmask("%0% бьёт %1% и %2%", tokens) is None  # made up one
+    assert unmask("Нет %0%", []) is None
+
+
+# Engines
+
+def test_translate_mock(cache):
+    mock = _engine("m", max_batch=2)
+    assert translate("m", ["Hello %name%", "Hello %foe%", "Bye"]) == \
+        ["HELLO %name%", "HELLO %foe%", "BYE"]
+    assert mock.stats == {"batches": 1, "texts": 2, "tokens": 5}
+    # All cached
+    assert translate("m", ["Hello %x%", "Bye"]) == ["HELLO %x%", "BYE"]
+    assert mock.stats["batches"] == 1
+
+def test_translate_mock_failures(cache):
+    texts = [f"Text number {w}" for w in "abcdefghijklmnopqrstuvwxyz"]
+    mock = _engine("m", failure_rate=0.5, max_batch=4)
+    res = translate("m", texts)
+    assert None in res
+    assert mock.stats["failed"] > 0
+    assert all(r is None or r == t.upper() for t, r in zip(texts, res))
+
+    # Same failures for the same setup
+    _engine("m2", failure_rate=0.5, max_batch=4)
+    assert translate("m2", texts) == res
+
+def test_translate_mock_concurrency(cache):
+    texts = [f"Text {a}{b}" for a in "abcdefgh" for b in "abcde"]  # Numbers would be masked
+    mock = _engine("m", latency=0.01, max_batch=5, max_concurrency=4)
+    assert translate("m", texts) == [t.upper() for t in texts]
+    assert mock.peak_in_flight == 4  # 8 batches, at most 4 at once
+
+def test_batches_token_limit():
+    mock = Mock("m", max_batch=10)
+    mock.max_batch_tokens = 10
+    assert [len(b) for b in mock.batches(["x" * 12] * 5)] == [2, 2, 1]
+
+
+def test_yandex_bad_replies(cache, monkeypatch):
+    class Reply:
+        status_code, text = 502, "<html>Bad Gateway</html>"
+        def json(self):
+            raise ValueError("Expecting value")
+
+    monkeypatch.setenv("YANDEX_OAUTH_TOKEN", "token")
+    monkeypatch.setattr(xt, "_post", lambda url, **kwargs: Reply())
+    with pytest.raises(xt.EngineError, match="Non-JSON reply 502"):
+        xt.translate_yandex(["Hello"])
+
+    Reply.json = lambda self: {"message": "Invalid token"}
+    with pytest.raises(xt.EngineError, match="Yandex IAM failed"):
+        xt.translate_yandex(["Hello"])
+
+
+def _engine(name, **kwargs):
+    xt.ENGINES[name] = engine = Mock(name, **kwargs)
+    return engine
+
+@pytest.fixture
+def cache():
+    xt.init_cache(":memory:")
+    yield
+    xt.con.close()
+    for name in list(xt.ENGINES):
+        if name.startswith("m") and name != "mock":
+            del xt.ENGINES[name]
@@ -1,9 +1,11 @@
 import os
 import sys
 import re
+from collections import Counter, defaultdict
 from pathlib import Path
+import asyncio
 import json
-import requests
+import random
 import hashlib
 from pprint import pprint
 from datetime import datetime, timedelta
@@ -47,30 +49,132 @@ def init():
     init_cache()
 
 def exit(message, extra=None):
+    warn(message, extra)
+    sys.exit(1)
+
+def warn(message, extra=None):
     text = red(message) + "\n" + extra if extra else red(message)
     print(text, file=sys.stderr)
-    sys.exit(1)
 
 
 def translate(engine, texts):
+    """Translates texts, returns None in place of those failed to translate.
+       Each engine batch is cached as soon as it's done, failed texts go to the run retry list."""
     if engine not in ENGINES:
         exit(f'Unknown translation engine "{engine}". Available options are: {", ".join(ENGINES)}')
-    
-    engine_func, conf = ENGINES[engine]
-    conf_key = get_conf_key(conf)
-
-    translated = [trans_get(engine, conf_key, t) for t in texts]
-    todo = {inp: i for i, (inp, out) in enumerate(zip(texts, translated)) if out is None}
-    if not todo:
-        return translated
-
-    todo_trans = engine_func(list(todo), conf)
+    return asyncio.run(translate_async(ENGINES[engine], texts))
+
+async def translate_async(engine, texts):
+    conf_key = get_conf_key(engine.conf)
+
+    masks = [mask(t) for t in texts]
+    translated = [None] * len(texts)
+    todo = defaultdict(list)  # masked text -> indexes, same masked text is only sent once
+    for i, (text, (masked, tokens)) in enumerate(zip(texts, masks)):
+        out = trans_get(engine.name, conf_key, masked)
+        if out is not None:
+            out = unmask(out, tokens)
+        if out is None and masked != text:  # Translated plain before, i.e. placeholders broken
+            out = trans_get(engine.name, conf_key, text)
+        if out is None:
+            todo[masked].append(i)
+        else:
+            translated[i] = out
+
+    limit = asyncio.Semaphore(engine.max_concurrency)
+
+    async def do_batch(batch):
+        async with limit:
+            outs = await _call_engine(engine, batch)
+        if outs is None:
+            return
+
+        broken = []
+        for inp, out in zip(batch, outs):
+            res = [unmask(out, masks[i][1]) for i in todo[inp]]
+            if None in res:
+                broken.extend(todo[inp])
+                continue
+            trans_set(engine.name, conf_key, inp, out)
+            for i, r in zip(todo[inp], res):
+                translated[i] = r
+
+        # The engine mangled placeholders, fall back to sending these as is
+        if broken:
+            plain = list(dict.fromkeys(texts[i] for i in broken))
+            print(yellow(f"Placeholders broken in {len(plain)} items, retrying unmasked"),
+                  file=sys.stderr)
+            async with limit:
+                plain_outs = await _call_engine(engine, plain)
+            if plain_outs is None:
+                return
+            plain_trans = dict(zip(plain, plain_outs))
+            for inp, out in plain_trans.items():
+                trans_set(engine.name, conf_key, inp, out)
+            for i in broken:
+                translated[i] = plain_trans[texts[i]]
+
+    await asyncio.gather(*map(do_batch, engine.batches(list(todo))))
+
+    if RUN:
+        run_pending(engine.name, [t for t, out in zip(texts, translated) if out is None])
+        run_resolved(engine.name, [t for t, out in zip(texts, translated) if out is not None])
+    return translated
 
-    for inp, out, i in zip(todo, todo_trans, todo.values()):
-        trans_set(engine, conf_key, inp, out)
-        translated[i] = out
+async def _call_engine(engine, texts):
+    engine.stats.update(batches=1, texts=len(texts), tokens=engine.estimate_tokens(texts))
+    try:
+        outs = await engine.translate_batch(texts)
+        if len(outs) != len(texts):
+            raise EngineError(f"Got {len(outs)} translations for {len(texts)} texts")
+        return outs
+    except EngineError as e:
+        engine.stats.update(failed=1)
+        warn(f"Failed to translate {len(texts)} items, added them to retry list", str(e))
+        return None
+
+def report():
+    """Prints what engines were asked to do to stderr"""
+    for name, engine in ENGINES.items():
+        if engine.stats:
+            st = engine.stats
+            print(yellow(f"{name}: {st['batches']} batches, {st['texts']} texts, "
+                         f"~{st['tokens']} tokens" + (f", {st['failed']} failed" if st['failed'] else "")),
+                  file=sys.stderr)
+
+
+# Placeholders
+#
+# Strings differing only in %name% vars, BBCode and html tags, <capture> markers and numbers are
+# the same to translate. These are masked as %0%, %1%, ... before cache lookup and sending to
+# an engine, then restored back. Same token gets the same placeholder.
+# Numbers followed by a word are left as is, its form depends on them, i.e. 2 дня, 5 дней.
+
+MASK_RE = re.compile(r'%\w+%|\[img\w*(?:=[^\]]*)?\][^\[]*\[/img\w*\]|\[/?\w+(?:=[^\]]*)?\]'
+                     r'|<[^<>]+>|[+-]?\d+(?:\.\d+)?(?:%|(?!\d|\.\d|(?:\[[^\]]*\])*\s*[^\W\d_]))')
+PLACEHOLDER_RE = re.compile(r'%(\d+)%')
+
+def mask(text):
+    tokens = []
+    def repl(m):
+        if m.group() not in tokens:
+            tokens.append(m.group())
+        return f'%{tokens.index(m.group())}%'
+
+    masked = MASK_RE.sub(repl, text)
+    # Some things like "%1%" in an original text won't survive, leave such text alone
+    if unmask(masked, tokens) != text:
+        return text, []
+    return masked, tokens
+
+def unmask(text, tokens):
+    """Restores masked tokens. Returns None if any placeholder is lost or made up."""
+    if not tokens:
+        return None if PLACEHOLDER_RE.search(text) else text
+    if {int(n) for n in PLACEHOLDER_RE.findall(text)} != set(range(len(tokens))):
+        return None
+    return PLACEHOLDER_RE.sub(lambda m: tokens[int(m.group(1))], text)
 
-    return translated
 
 def get_conf_key(conf):
     if not conf:
@@ -78,22 +182,82 @@ def get_conf_key(conf):
     s = json.dumps(conf, sort_keys=True)
     return hashlib.md5(s.encode("utf-8")).hexdigest()
 
-def register_engine(engine, conf):
-    def register(func):
-        ENGINES[engine] = func, conf
-        return func
+
+# Engines
+
+class EngineError(Exception):
+    pass
+
+class Engine:
+    """Translation engine interface.
+
+       Subclasses implement async translate_batch(), which gets at most max_batch texts and
+       ~max_batch_tokens tokens at once. Up to max_concurrency batches are translated in parallel.
+       conf goes into a cache key, i.e. changing it invalidates cached translations."""
+    conf = {}
+    max_batch = 25
+    max_batch_tokens = None
+    max_concurrency = 1
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = Counter()
+
+    async def translate_batch(self, texts):
+        raise NotImplementedError
+
+    def estimate_tokens(self, texts):
+        return sum(len(t) for t in texts) // 4 + len(texts)  # ~4 chars per token in english
+
+    def batches(self, texts):
+        batch = []
+        for text in texts:
+            if batch and (len(batch) >= self.max_batch or self.max_batch_tokens
+                          and self.estimate_tokens(batch + [text]) > self.max_batch_tokens):
+                yield batch
+                batch = []
+            batch.append(text)
+        if batch:
+            yield batch
+
+def register_engine(name):
+    def register(cls):
+        ENGINES[name] = cls(name)
+        return cls
     return register
 
+def _post(url, **kwargs):
+    import requests
+    try:
+        return requests.post(url, **kwargs)
+    except requests.RequestException as e:
+        raise EngineError(str(e))
 
-@register_engine("yt", {})
-def translate_yandex(texts, conf):
-    if not os.environ.get("YANDEX_OAUTH_TOKEN") or not os.environ.get("YANDEX_FOLDER_ID"):
-        exit("Please set up YANDEX_OAUTH_TOKEN and YANDEX_FOLDER_ID in .env file")
+def _json(response):
+    """Parses a reply, i.e. an HTML error page from a proxy fails the batch, not the run"""
+    try:
+        return response.json()
+    except ValueError:
+        raise EngineError(f"Non-JSON reply {response.status_code}:\n{response.text[:500]}")
 
+
+@register_engine("yt")
+class Yandex(Engine):
+    max_batch = 100
+    max_concurrency = 4
+
+    async def translate_batch(self, texts):
+        if not os.environ.get("YANDEX_OAUTH_TOKEN") or not os.environ.get("YANDEX_FOLDER_ID"):
+            exit("Please set up YANDEX_OAUTH_TOKEN and YANDEX_FOLDER_ID in .env file")
+        return await asyncio.to_thread(translate_yandex, texts)
+
+def translate_yandex(texts):
     yandex_iam = cache_get("yandex_iam")
     if not yandex_iam:
-        res = requests.post("https://iam.api.cloud.yandex.net/iam/v1/tokens",
-            json={"yandexPassportOauthToken": os.environ["YANDEX_OAUTH_TOKEN"]}).json()
+        res = _json(_post("https://iam.api.cloud.yandex.net/iam/v1/tokens",
+            json={"yandexPassportOauthToken": os.environ["YANDEX_OAUTH_TOKEN"]}))
+        if "iamToken" not in res:
+            raise EngineError("Yandex IAM failed with:\n" + json.dumps(res))
         yandex_iam = res["iamToken"]
         cache_set("yandex_iam", yandex_iam, datetime.now() + timedelta(hours=12))
 
@@ -108,13 +272,14 @@ def translate_yandex(texts, conf):
         "texts": texts,
         "folderId": os.environ["YANDEX_FOLDER_ID"],
     }
-    response = requests.post('https://translate.api.cloud.yandex.net/translate/v2/translate',
+    response = _post('https://translate.api.cloud.yandex.net/translate/v2/translate',
         json = body,
         headers = headers
     )
-    if 'translations' not in response.json():
-        exit("Yandex translate failed with:", response.text)
-    return [item['text'] for item in response.json()['translations']]
+    data = _json(response)
+    if 'translations' not in data:
+        raise EngineError("Yandex translate failed with:\n" + response.text)
+    return [item['text'] for item in data['translations']]
 
 
 CONTEXT = "These are strings from Battle Brothers game, set in middle age Europe, it also has some fantasy elements like witches, weidegangers and greenskins."
@@ -146,7 +311,18 @@ CLAUDE_CONF = {
     "target_language_full": target_language_full
 }
 
-@register_engine("claude35", CLAUDE_CONF)
+@register_engine("claude35")
+class Claude35(Engine):
+    conf = CLAUDE_CONF
+    # The answer is capped by max_tokens in anthropic(), russian takes 2-3 times more tokens
+    max_batch_tokens = 350
+    max_concurrency = 2
+
+    async def translate_batch(self, texts):
+        if not os.environ.get("ANTHROPIC_URL") or not os.environ.get("ANTHROPIC_TOKEN"):
+            exit("Please set up ANTHROPIC_URL and ANTHROPIC_TOKEN in .env file")
+        return await asyncio.to_thread(translate_claude35, texts, self.conf)
+
 def translate_claude35(texts, conf):
     print(f"Claude3.5 translating {len(texts)} items...", file=sys.stderr);
 
@@ -159,6 +335,8 @@ def translate_claude35(texts, conf):
         print(prompt)
 
     data = anthropic(prompt)
+    if "content" not in data:
+        raise EngineError("Claude failed with:\n" + json.dumps(data))
     response_text = data["content"][0]["text"]
 
 #     response_text = """
@@ -176,16 +354,13 @@ def translate_claude35(texts, conf):
     junk = parts[::2]
     translations = parts[1::2]
     if not all(not s or s.isspace() for s in junk):
-        exit("Extra junk in the answer:", response_text)
+        raise EngineError("Extra junk in the answer:\n" + response_text)
     if len(translations) != len(texts):
-        exit("Wrong number of translations:", response_text)
+        raise EngineError("Wrong number of translations:\n" + response_text)
     return translations
 
 
 def anthropic(prompt):
-    if not os.environ.get("ANTHROPIC_URL") or not os.environ.get("ANTHROPIC_TOKEN"):
-        exit("Please set up ANTHROPIC_URL and ANTHROPIC_TOKEN in .env file")
-
     url = os.environ["ANTHROPIC_URL"]
     headers = {
         "Content-Type": "application/json",
@@ -197,18 +372,51 @@ def anthropic(prompt):
         "messages": [{"role": "user", "content": prompt}],
         "max_tokens": 1024
     }
-    response = requests.post(url, json=body, headers=headers)
+    data = _json(_post(url, json=body, headers=headers))
 
     if DEBUG:
         print("=" * 80)
-        pprint(response.json())
+        pprint(data)
         print("-" * 80)
 
-    return response.json()
+    return data
+
+
+@register_engine("mock")
+class Mock(Engine):
+    """Offline engine for tests and benchmarks, "translates" by uppercasing. Latency and
+       failure rate are configurable, XT_MOCK_LATENCY and XT_MOCK_FAILURE_RATE env vars are used
+       for -tmock. Failures are deterministic: decided by batch texts and attempt number."""
+    def __init__(self, name, latency=None, failure_rate=None, seed=0, max_batch=25,
+                 max_concurrency=4):
+        super().__init__(name)
+        self.latency = float(os.environ.get("XT_MOCK_LATENCY", 0) if latency is None else latency)
+        self.failure_rate = float(
+            os.environ.get("XT_MOCK_FAILURE_RATE", 0) if failure_rate is None else failure_rate)
+        self.seed = seed
+        self.max_batch, self.max_concurrency = max_batch, max_concurrency
+        self.attempts = Counter()
+        self.in_flight = self.peak_in_flight = 0
+
+    async def translate_batch(self, texts):
+        key = get_conf_key([self.seed, texts])
+        self.attempts[key] += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        if random.Random(f"{key}:{self.attempts[key]}").random() < self.failure_rate:
+            raise EngineError("Mock failure")
+        return [t.upper() for t in texts]
 
 
 def load_dotenv():
-    with Path(__file__).with_name(".env").open() as fd:
+    path = Path(__file__).with_name(".env")
+    if not path.exists():
+        return
+    with path.open() as fd:
         for line in fd:
             var, val = line.strip().split('=', 1)
             os.environ[var] = val
@@ -218,10 +426,12 @@ def load_dotenv():
 import sqlite3
 
 sqlite3.register_adapter(datetime, str)
-con = sqlite3.connect(Path(__file__).with_name("translations.db"), autocommit=True)
+con = None
 
 
-def init_cache():
+def init_cache(path=None):
+    global con
+    con = sqlite3.connect(path or Path(__file__).with_name("translations.db"), isolation_level=None)
     create_sql = '''
     CREATE TABLE IF NOT EXISTS translations_cache_ru (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -240,6 +450,26 @@ def init_cache():
         ckey TEXT NOT null UNIQUE,
         cval TEXT NOT null
     );
+
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished TIMESTAMP,
+        rkey TEXT NOT null
+    );
+    CREATE TABLE IF NOT EXISTS run_files (
+        run INTEGER NOT null,
+        file TEXT NOT null,
+        output TEXT NOT null,
+        state TEXT NOT null,
+        PRIMARY KEY (run, file)
+    );
+    CREATE TABLE IF NOT EXISTS run_pending (
+        run INTEGER NOT null,
+        engine TEXT NOT null,
+        input TEXT NOT null,
+        PRIMARY KEY (run, engine, input)
+    );
     '''
     con.cursor().executescript(create_sql)
 
@@ -259,6 +489,61 @@ def cache_get(key):
     sql = f"SELECT cval FROM cache WHERE ckey = ? and expires < ?"
     return fetch_val(sql, key, datetime.now())
 
+
+# Runs
+#
+# A run is an extraction with an engine over some path. Files done are stored along with their
+# output, so that a run stopped half way could be resumed without redoing them.
+
+RUN = None
+
+def start_run(params, resume=False):
+    """Starts a new run or picks up an unfinished one with the same params if resume is set.
+       Returns {file: (output, state)} for the files already done."""
+    global RUN
+    rkey = get_conf_key(params)
+    sql = "SELECT id FROM runs WHERE rkey = ? AND finished IS null ORDER BY id DESC LIMIT 1"
+    RUN = fetch_val(sql, rkey) if resume else None
+    if RUN is None:
+        if resume:
+            print(yellow("Nothing to resume, starting a new run"), file=sys.stderr)
+        RUN = con.execute("INSERT INTO runs (rkey) VALUES (?)", (rkey,)).lastrowid
+        return {}
+
+    done = {file: (output, json.loads(state)) for file, output, state in con.execute(
+        "SELECT file, output, state FROM run_files WHERE run = ?", (RUN,))}
+    pending = fetch_val("SELECT count(*) FROM run_pending WHERE run = ?", RUN)
+    print(yellow(f"Resuming run: {len(done)} files done, {pending} texts pending"), file=sys.stderr)
+    return done
+
+def run_file_done(file, output, state):
+    con.execute("REPLACE INTO run_files (run, file, output, state) VALUES (?, ?, ?, ?)",
+                (RUN, str(file), output, json.dumps(state)))
+
+def run_pending(engine, texts):
+    con.executemany("REPLACE INTO run_pending (run, engine, input) VALUES (?, ?, ?)",
+                    [(RUN, engine, t) for t in texts])
+
+def run_resolved(engine, texts):
+    con.executemany("DELETE FROM run_pending WHERE run = ? AND engine = ? AND input = ?",
+                    [(RUN, engine, t) for t in texts])
+
+def retry_pending(engine):
+    """Translates texts failed in the previous attempts of the current run."""
+    texts = [t for t, in con.execute(
+        "SELECT input FROM run_pending WHERE run = ? AND engine = ?", (RUN, engine))]
+    if texts:
+        print(yellow(f"Retrying {len(texts)} failed texts"), file=sys.stderr)
+        translate(engine, texts)
+
+def finish_run():
+    """Marks the run finished unless something failed, returns the number of failed texts."""
+    pending = fetch_val("SELECT count(*) FROM run_pending WHERE run = ?", RUN)
+    if not pending:
+        con.execute("UPDATE runs SET finished = ? WHERE id = ?", (datetime.now(), RUN))
+    return pending
+
+
 def fetch_val(sql, *params):
     res = _do_sql(sql, params)
     return res[0] if res else None